@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#
+# Audit many names at once with tracegraph, writing one JSON line per name
+#
+# ./audit.py -h gives you help output
+#
+# Names are traced by a pool of worker processes, one name at a time per
+# worker. The workers are started after everything they share is set up
+# (tracegraph itself, the root servers, the fake hierarchy if any), and keep
+# the delegations to the tlds from name to name, so the root servers are
+# only asked about a tld once per worker and not once per name. Every
+# result is written as soon as its name is done, so results are not in
+# input order: each has the line number of its name in the input.
+#
+# Memory use does not depend on the number of names: names are read as
+# they are needed, and never more than --window lines past the first name
+# that isn't done yet. Which lines are done is saved next to the output in
+# OUTPUT.progress, --resume continues where an earlier, interrupted, run
+# left off.
+#
+# This file is distributed under the same license as tracegraph.py
+
+import collections
+import dns.exception
+import dns.rdatatype
+import dns.reversename
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import tracegraph
+
+log = lambda x: sys.stderr.write(x + "\n")
+
+# The tree every name is traced in and how to trace, set up by bootstrap()
+# before the workers are started
+tree = None
+settings = {}
+
+def bootstrap(rdtype=dns.rdatatype.A, deadline=None, trace_missing_glue=False, even_trace_m_gtld_servers_net=False, **options):
+    # Everything the workers share, done once in this process so they
+    # inherit it instead of all doing it themselves. Options are passed to
+    # tracegraph.root()
+    global tree
+    tracegraph.log = lambda x: None
+    tracegraph.ipv6_available()
+    tree = tracegraph.root(**options)
+    tree.trace_missing_glue = trace_missing_glue
+    tree.even_trace_m_gtld_servers_net = even_trace_m_gtld_servers_net
+    tree.find_root_resolvers()
+    settings.clear()
+    settings.update(rdtype=rdtype, deadline=deadline)
+
+def audit_name(root, name, rdtype=dns.rdatatype.A, deadline=None):
+    # Trace a single name and summarize what's wrong with it. Names are
+    # traced from the zones that earlier names in the same root found, what
+    # has expired is traced again.
+    rdtypes = isinstance(rdtype, (list, tuple, set)) and rdtype or [rdtype]
+    if dns.rdatatype.PTR in rdtypes:
+        try:
+            name = dns.reversename.from_address(name).to_text()
+        except dns.exception.SyntaxError:
+            pass
+    if not name.endswith('.'):
+        name += '.'
+    start = time.time()
+    root.stats = tracegraph.TraceStats()
+    root.deadline = deadline and start + deadline or None
+    root.refresh([name], rdtype)
+    inconsistencies = root.inconsistencies(names=[name])
+    names = root.subtree([name])[0]
+    truncated = len([x for x in names if tracegraph.truncated in root.names[x].addresses])
+    summary = root.stats.summary()
+    return {
+        'name': name,
+        'status': inconsistencies and 'inconsistent' or truncated and 'incomplete' or 'consistent',
+        'inconsistencies': [str(x) for x in inconsistencies],
+        'kinds': dict(collections.Counter([x.kind for x in inconsistencies])),
+        'truncated': truncated,
+        'queries': summary['queries'],
+        'sent': summary['sent'],
+        'cached': summary['cached'],
+        'duration': time.time() - start,
+        'critical_path': summary['critical_path'],
+    }
+
+def forget(root):
+    # Only keep what every name needs, the root and the tlds, so the tree
+    # doesn't grow with every name that's traced
+    for zone in root.subzones.keys():
+        if zone.count('.') > 1:
+            del root.subzones[zone]
+    root.names.clear()
+    root.stats = None
+
+def init_worker():
+    # ^C goes to the whole process group, the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def work(job):
+    line, name = job
+    try:
+        result = audit_name(tree, name, **settings)
+    except Exception:
+        result = {'name': name, 'status': 'failed', 'error': traceback.format_exc()}
+    forget(tree)
+    result['line'] = line
+    # Encoded here, the parent only has to write it
+    return line, result['status'], json.dumps(result, sort_keys=True)
+
+class Progress(object):
+    # Which input lines are done: all lines before done, and the lines in
+    # ahead, which finished before an earlier line did
+    def __init__(self, path=None, window=100):
+        self.path = path
+        self.window = window
+        self.done = 1
+        self.ahead = set()
+        self.stopped = False
+        self.saved = 0
+        self.cond = threading.Condition()
+
+    def __contains__(self, line):
+        return line < self.done or line in self.ahead
+
+    def load(self, output):
+        # Results can be written after the progress was last saved, those
+        # are found in the output. A result that was only partly written
+        # when we were stopped is removed.
+        if os.path.exists(self.path):
+            with open(self.path) as fd:
+                self.done = int(fd.read())
+        if not os.path.exists(output):
+            return
+        end = 0
+        with open(output, 'rb') as fd:
+            for data in fd:
+                if not data.endswith('\n'):
+                    break
+                end += len(data)
+                line = json.loads(data)['line']
+                if line >= self.done:
+                    self.ahead.add(line)
+        if end != os.path.getsize(output):
+            with open(output, 'rb+') as fd:
+                fd.truncate(end)
+        self.add(None)
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + '.tmp', 'w') as fd:
+            fd.write("%d\n" % self.done)
+        os.rename(self.path + '.tmp', self.path)
+        self.saved = time.time()
+
+    def add(self, line):
+        with self.cond:
+            if line is not None:
+                self.ahead.add(line)
+            while self.done in self.ahead:
+                self.ahead.remove(self.done)
+                self.done += 1
+            self.cond.notify_all()
+
+    def wait(self, line):
+        # Don't get more than window lines ahead of the first line that isn't
+        # done. Returns False when stopped.
+        with self.cond:
+            while line >= self.done + self.window and not self.stopped:
+                self.cond.wait()
+            return not self.stopped
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def jobs(fd, progress):
+    # Runs in the pool's task handler thread
+    for line, name in enumerate(fd, 1):
+        if line in progress:
+            continue
+        name = name.strip()
+        if not name or name.startswith('#'):
+            progress.add(line)
+            continue
+        if not progress.wait(line):
+            return
+        yield line, name
+
+def results(iterator):
+    # Waiting without a timeout can't be interrupted with ^C
+    while True:
+        try:
+            yield iterator.next(1)
+        except multiprocessing.TimeoutError:
+            pass
+
+def audit(names, output, processes=None, window=None, progress=None, **options):
+    # Audit the names in file object names, writing results to file object
+    # output. Returns a Counter of the statuses of the results.
+    processes = processes or multiprocessing.cpu_count()
+    progress = progress or Progress()
+    progress.window = window or processes * 4
+    bootstrap(**options)
+    statuses = collections.Counter()
+    start = time.time()
+    pool = multiprocessing.Pool(processes, init_worker)
+    try:
+        for line, status, result in results(pool.imap_unordered(work, jobs(names, progress))):
+            output.write(result + "\n")
+            output.flush()
+            progress.add(line)
+            statuses[status] += 1
+            if time.time() - progress.saved > 1:
+                progress.save()
+            if not sum(statuses.values()) % 1000:
+                log("Audited %d names in %.1fs" % (sum(statuses.values()), time.time() - start))
+    except KeyboardInterrupt:
+        progress.stop()
+        pool.terminate()
+        raise
+    finally:
+        progress.save()
+    pool.close()
+    pool.join()
+    return statuses
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = """%prog [options] [file] - Audit many names, writing one JSON line per name
+
+Names are read from file, one per line, or from stdin if no file is given.
+
+Examples:
+%prog --output portfolio.jsonl portfolio.txt
+%prog --output portfolio.jsonl --resume portfolio.txt
+%prog --processes 32 --deadline 60 < portfolio.txt > portfolio.jsonl"""
+
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('-q', '--quiet', dest='quiet', action="store_true", default=False,
+                 help="No diagnostic messages")
+    p.add_option('-t', '--type', dest='rdtypes', action='append', default=[], choices=('A', 'AAAA', 'MX', 'TXT', 'SRV', 'SOA', 'PTR'),
+                 help="Which record type to query (may be repeated)")
+    p.add_option('-o', '--output', dest='output', default=None, metavar='FILE',
+                 help="Write the results to FILE instead of stdout")
+    p.add_option('-r', '--resume', dest='resume', action='store_true', default=False,
+                 help="Skip the names that an earlier run already wrote to the output")
+    p.add_option('-p', '--processes', dest='processes', type='int', default=None, metavar='N',
+                 help="Number of names to trace at the same time, each in its own process (default: one per cpu)")
+    p.add_option('-w', '--window', dest='window', type='int', default=None, metavar='N',
+                 help="Read no more than N lines past the first name that isn't done (default: 4 per process)")
+    p.add_option('--deadline', dest='deadline', type='float', default=None, metavar='SECONDS',
+                 help="Stop tracing a name after this many seconds and use what was found so far")
+    p.add_option('--max-queries', dest='max_queries', type='int', default=None, metavar='N',
+                 help="Stop tracing a name after this many queries and use what was found so far")
+    p.add_option('--max-depth', dest='max_depth', type='int', default=None, metavar='N',
+                 help="Don't follow more than this many delegations, CNAMEs and other targets in a row")
+    p.add_option('--max-cname-chain', dest='max_cname_chain', type='int', default=None, metavar='N',
+                 help="Don't follow more than this many CNAMEs in a row")
+    p.add_option('-c', '--concurrency', dest='concurrency', type='int', default=10, metavar='N',
+                 help="Number of nameservers each process queries in parallel (1 disables parallel queries)")
+    p.add_option('-P', '--prime', dest='prime', action='store_true', default=False,
+                 help="Ask a root server for the current root servers instead of using the built-in root hints")
+    p.add_option('-A', '--all-addresses', dest='all_addresses', action='store_true', default=False,
+                 help="Query every address of every nameserver, not just the first one")
+    p.add_option('-4', '--ipv4', dest='ipv6', action='store_false', default=None,
+                 help="Only use IPv4 to talk to nameservers")
+    p.add_option('-6', '--ipv6', dest='ipv6', action='store_true',
+                 help="Also use IPv6 to talk to nameservers, even if it doesn't seem to be available")
+    p.add_option('-F', '--fake', dest='fake', default=None, metavar='FILE',
+                 help="Query a fake DNS hierarchy described in FILE instead of the internet, see fakedns.py")
+    p.add_option('-T', '--trace-missing-glue', dest='trace_missing_glue', action='store_true', default=False,
+                 help="Perform full traces for nameserver for which we did not receive glue records")
+
+    opts, args = p.parse_args()
+    if len(args) > 1:
+        p.error("Only one file of names can be audited at a time")
+    if opts.resume and not opts.output:
+        p.error("--resume needs the --output of the earlier run")
+
+    if opts.quiet:
+        log = lambda x: None
+    if opts.ipv6 is not None:
+        tracegraph.have_ipv6 = opts.ipv6
+
+    rdtypes = [dns.rdatatype.from_text(x) for x in tracegraph.unique(opts.rdtypes or ['A'])]
+    transport = None
+    if opts.fake:
+        import fakedns
+        with open(opts.fake) as fd:
+            transport = fakedns.FakeTransport.load(fd)
+
+    progress = Progress(opts.output and opts.output + '.progress')
+    if opts.resume:
+        progress.load(opts.output)
+        log("Resuming at line %d" % progress.done)
+    elif opts.output and os.path.exists(progress.path):
+        os.unlink(progress.path)
+    names = args and open(args[0]) or sys.stdin
+    output = opts.output and open(opts.output, opts.resume and 'a' or 'w') or sys.stdout
+
+    start = time.time()
+    try:
+        statuses = audit(names, output, processes=opts.processes, window=opts.window, progress=progress,
+                         transport=transport, prime=opts.prime, rdtype=len(rdtypes) == 1 and rdtypes[0] or rdtypes,
+                         concurrency=opts.concurrency, all_addresses=opts.all_addresses,
+                         trace_missing_glue=opts.trace_missing_glue, deadline=opts.deadline,
+                         max_queries=opts.max_queries, max_depth=opts.max_depth, max_cname_chain=opts.max_cname_chain)
+    except KeyboardInterrupt:
+        log("Interrupted at line %d%s" % (progress.done, opts.output and ", use --resume to continue" or ""))
+        sys.exit(1)
+    log("Audited %d names in %.1fs: %s" % (sum(statuses.values()), time.time() - start,
+        ', '.join(['%d %s' % (y, x) for x, y in sorted(statuses.items())]) or 'nothing to do'))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#
+# Benchmarks for tracegraph on synthetic DNS hierarchies
+#
+# ./benchmark.py -h gives you help output
+#
+# Builds a Zone tree of configurable size directly, without doing any
+# queries, and times graphing, (de)serializing, dumping and loading it. The
+# trace engine itself is timed against the same hierarchy served by
+# fakedns.FakeTransport, and so is importing tracegraph in a fresh python.
+# How much memory trees take is measured too, both built directly and loaded
+# from dumps. Results are written as JSON, and can be compared to the results
+# of an earlier run with --compare.
+#
+# This file is distributed under the same license as tracegraph.py
+
+import cStringIO
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import types
+
+import fakedns
+import tracegraph
+
+def ip(*parts):
+    return '10.%d.%d.%d' % (parts[0] % 256, parts[1] % 256, parts[2] % 256)
+
+class Hierarchy(object):
+    # A synthetic hierarchy: tlds, zones spread over them, nameservers for
+    # each zone and names spread over the zones. Every name is the start of a
+    # CNAME chain of the given depth that ends in an A record. Every
+    # error_every'th name gets a different answer from one nameserver.
+    def __init__(self, zones=100, nameservers=4, names=1000, depth=1, tlds=3, error_every=10):
+        self.tlds = ['tld%d.' % x for x in range(tlds)]
+        self.zones = ['zone%d.%s' % (x, self.tlds[x % tlds]) for x in range(zones)]
+        self.nameservers = nameservers
+        self.names = ['name%d.%s' % (x, self.zones[x % zones]) for x in range(names)]
+        self.depth = depth
+        self.error_every = error_every
+        self.index = dict([(x, i) for i, x in enumerate(self.tlds + self.zones)])
+
+    def ns(self, zone, idx):
+        return 'ns%d.%s' % (idx, zone)
+
+    def ns_ip(self, zone, idx):
+        return ip(self.index[zone] // 256, self.index[zone], idx)
+
+    def chain(self, name):
+        # The names in the CNAME chain starting at name, the last one has the A record
+        first, zone = name.split('.', 1)
+        return [name] + ['%s-%d.%s' % (first, x, zone) for x in range(1, self.depth + 1)]
+
+    def address(self, num, wrong=False):
+        return '192.0.%d.%d' % ((num // 250) % 256, num % 250 + (wrong and 1 or 0))
+
+    def description(self, latency=0):
+        servers = {}
+        zones = {'.': {'ns': [x[0] for x in tracegraph.root_hints]}}
+        for root, ipv4, ipv6 in tracegraph.root_hints:
+            servers[root] = {'ip': [ipv4], 'latency': latency}
+        for zone in self.tlds + self.zones:
+            zones[zone] = {'ns': [self.ns(zone, x) for x in range(self.nameservers)], 'records': {}}
+            for x in range(self.nameservers):
+                servers[self.ns(zone, x)] = {'ip': [self.ns_ip(zone, x)], 'latency': latency, 'records': {}}
+        for num, name in enumerate(self.names):
+            zone = name.split('.', 1)[1]
+            chain = self.chain(name)
+            for name, target in zip(chain, chain[1:]):
+                zones[zone]['records'][name] = {'CNAME': [target]}
+            zones[zone]['records'][chain[-1]] = {'A': [self.address(num)]}
+            if self.error_every and num % self.error_every == 0:
+                servers[self.ns(zone, 0)]['records'][chain[-1]] = {'A': [self.address(num, True)]}
+        return {'servers': servers, 'zones': zones}
+
+    def tree(self):
+        # The tree a trace of all names would produce
+        root = tracegraph.root(live=True)
+        root.find_root_resolvers()
+        parents = {'.': root.resolvers.values()}
+        for zone in self.tlds + self.zones:
+            inst = root.subzones[zone] = tracegraph.Zone(zone, root)
+            parent = zone in self.tlds and '.' or zone.split('.', 1)[1]
+            for x in range(self.nameservers):
+                resolver = inst.resolvers[self.ns(zone, x)] = tracegraph.Resolver(inst, self.ns(zone, x))
+                resolver.ip = [self.ns_ip(zone, x)]
+                for up in parents[parent]:
+                    resolver.add_up(up)
+            parents[zone] = inst.resolvers.values()
+        for num, name in enumerate(self.names):
+            zone = root.subzones[name.split('.', 1)[1]]
+            resolvers = [zone.resolvers[self.ns(zone.name, x)] for x in range(self.nameservers)]
+            chain = self.chain(name)
+            for name, target in zip(chain, chain[1:]):
+                root.names[name] = tracegraph.Name(name)
+                for resolver in resolvers:
+                    root.names[name].add(target, resolver)
+            name = root.names[chain[-1]] = tracegraph.Name(chain[-1])
+            for resolver in resolvers:
+                if self.error_every and num % self.error_every == 0 and resolver is resolvers[0]:
+                    name.add(self.address(num, True), resolver)
+                else:
+                    name.add(self.address(num), resolver)
+        return root
+
+def timed(func, repeat):
+    times = []
+    for x in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2], 'max': times[-1], 'runs': repeat}
+
+def sizeof(root):
+    # Bytes taken by a tree, counting objects that are shared by several
+    # parts of it once. What the root zone uses for querying doesn't count.
+    seen = set([id(root.cache), id(root.rtt), id(root.transport), id(root.lock)])
+    todo = [root]
+    size = 0
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        todo.extend(gc.get_referents(obj))
+    return size
+
+def run(hierarchy, repeat=3, trace_names=100, latency=0, concurrency=10, only=None):
+    root = hierarchy.tree()
+    serialized = root.serialize()
+    dumped = {}
+    for format in ('yaml', 'json', 'jsonl'):
+        fd = cStringIO.StringIO()
+        root.dump(format, fd)
+        dumped[format] = fd.getvalue()
+    description = hierarchy.description(latency)
+
+    def trace():
+        transport = fakedns.FakeTransport(description)
+        inst = tracegraph.root(concurrency=concurrency, live=True, transport=transport)
+        inst.trace_names(hierarchy.names[:trace_names])
+
+    def python(code):
+        # Startup time matters for the CLI and for web workers, so time it
+        # in a fresh interpreter
+        subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    benchmarks = [
+        ('startup', lambda: python('pass')),
+        ('import', lambda: python('import tracegraph')),
+        ('graph', lambda: root.graph()),
+        ('graph_errors_only', lambda: root.graph(errors_only=True)),
+        ('graph_skip', lambda: root.graph(skip=['.'] + hierarchy.tlds)),
+        ('graph_one_name', lambda: root.graph(names=hierarchy.names[:1])),
+        ('serialize', lambda: root.serialize()),
+        ('deserialize', lambda: tracegraph.Zone.deserialize(serialized)),
+        ('dump_yaml', lambda: root.dump('yaml', cStringIO.StringIO())),
+        ('load_yaml', lambda: tracegraph.Zone.load('yaml', cStringIO.StringIO(dumped['yaml']))),
+        ('dump_json', lambda: root.dump('json', cStringIO.StringIO())),
+        ('load_json', lambda: tracegraph.Zone.load('json', cStringIO.StringIO(dumped['json']))),
+        ('dump_jsonl', lambda: root.dump('jsonl', cStringIO.StringIO())),
+        ('load_jsonl', lambda: tracegraph.Zone.load('jsonl', cStringIO.StringIO(dumped['jsonl']))),
+        ('load_jsonl_one_name', lambda: tracegraph.Zone.load('jsonl', cStringIO.StringIO(dumped['jsonl']), names=hierarchy.names[:1])),
+        ('load_jsonl_names', lambda: tracegraph.LazyDump(cStringIO.StringIO(dumped['jsonl'])).names()),
+        ('trace', trace),
+    ]
+    results = {}
+    for name, func in benchmarks:
+        if only and name not in only:
+            continue
+        log("Running %s" % name)
+        results[name] = timed(func, repeat)
+
+    def traced():
+        inst = tracegraph.root(concurrency=concurrency, live=True, transport=fakedns.FakeTransport(description))
+        inst.trace_names(hierarchy.names[:trace_names])
+        return inst
+
+    trees = [
+        ('memory_tree', lambda: root),
+        ('memory_load_json', lambda: tracegraph.Zone.load('json', cStringIO.StringIO(dumped['json']))),
+        ('memory_load_jsonl', lambda: tracegraph.Zone.load('jsonl', cStringIO.StringIO(dumped['jsonl']))),
+        ('memory_trace', traced),
+    ]
+    memory = {}
+    for name, func in trees:
+        if only and name not in only:
+            continue
+        log("Measuring %s" % name)
+        memory[name] = sizeof(func())
+    return results, memory
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    print("%-20s %12s %12s %8s" % ('benchmark', 'old', 'new', 'ratio'))
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        o, n = old['results'][name]['min'], new['results'][name]['min']
+        print("%-20s %12.6f %12.6f %8.2f" % (name, o, n, o and n / o or 0))
+    for name in sorted(new.get('memory', {})):
+        if name not in old.get('memory', {}):
+            continue
+        o, n = old['memory'][name], new['memory'][name]
+        print("%-20s %12d %12d %8.2f" % (name, o, n, o and float(n) / o or 0))
+
+log = lambda x: sys.stderr.write(x + "\n")
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = """%prog [options] - Benchmark tracegraph on a synthetic DNS hierarchy
+
+Examples:
+%prog --output before.json
+%prog --zones 1000 --names 10000 --cname-depth 3 --compare before.json"""
+
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('-q', '--quiet', dest='quiet', action="store_true", default=False,
+                 help="No diagnostic messages")
+    p.add_option('-z', '--zones', dest='zones', type='int', default=100,
+                 help="Number of zones")
+    p.add_option('-t', '--tlds', dest='tlds', type='int', default=3,
+                 help="Number of top level domains the zones are spread over")
+    p.add_option('-n', '--nameservers', dest='nameservers', type='int', default=4,
+                 help="Number of nameservers per zone")
+    p.add_option('-N', '--names', dest='names', type='int', default=1000,
+                 help="Number of names")
+    p.add_option('-c', '--cname-depth', dest='depth', type='int', default=1,
+                 help="Length of the CNAME chain for each name")
+    p.add_option('-e', '--error-every', dest='error_every', type='int', default=10,
+                 help="Make every Nth name inconsistent (0 for none)")
+    p.add_option('-T', '--trace-names', dest='trace_names', type='int', default=100,
+                 help="Number of names to trace in the trace benchmark")
+    p.add_option('-l', '--latency', dest='latency', type='float', default=0,
+                 help="Simulated latency per query in the trace benchmark")
+    p.add_option('-C', '--concurrency', dest='concurrency', type='int', default=10,
+                 help="Concurrency for the trace benchmark")
+    p.add_option('-b', '--benchmark', dest='only', action='append', default=[],
+                 help="Only run this benchmark (may be repeated)")
+    p.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                 help="Number of times to run each benchmark")
+    p.add_option('-o', '--output', dest='output', default=None, metavar='FILE',
+                 help="Write the results to FILE instead of stdout")
+    p.add_option('--compare', dest='compare', default=None, metavar='FILE',
+                 help="Compare the results with an earlier run")
+
+    opts, args = p.parse_args()
+    if args:
+        p.error("No arguments expected")
+
+    if opts.quiet:
+        log = lambda x: None
+    tracegraph.log = lambda x: None
+
+    hierarchy = Hierarchy(zones=opts.zones, nameservers=opts.nameservers, names=opts.names,
+                          depth=opts.depth, tlds=opts.tlds, error_every=opts.error_every)
+    timings, memory = run(hierarchy, repeat=opts.repeat, trace_names=opts.trace_names,
+                          latency=opts.latency, concurrency=opts.concurrency, only=opts.only)
+    results = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'time': time.time(),
+        'parameters': {
+            'zones': opts.zones, 'tlds': opts.tlds, 'nameservers': opts.nameservers,
+            'names': opts.names, 'cname_depth': opts.depth, 'error_every': opts.error_every,
+            'trace_names': opts.trace_names, 'latency': opts.latency,
+            'concurrency': opts.concurrency, 'repeat': opts.repeat,
+        },
+        'results': timings,
+        'memory': memory,
+    }
+
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    elif not opts.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print("")
+
+    if opts.compare:
+        with open(opts.compare) as fd:
+            compare(json.load(fd), results)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# An in-memory DNS hierarchy that can stand in for the internet, so traces
+# can be run offline, deterministically and fast. Use it as the transport
+# for tracegraph:
+#
+#   root = tracegraph.root(transport=fakedns.FakeTransport(description))
+#
+# or use tracegraph.py --fake=FILE with the description in a YAML file. A
+# description looks like this:
+#
+#   servers:
+#     a.root-servers.net.: {ip: [198.41.0.4]}
+#     a.gtld-servers.net.: {ip: [192.5.6.30], latency: 0.05}
+#     ns1.example.com.:    {ip: [10.0.0.1, 'fd00::1']}
+#     ns2.example.com.:    {ip: [10.0.0.2], records: {www.example.com.: {A: [10.1.1.2]}}}
+#     ns3.example.com.:    {ip: [10.0.0.3], loss: 0.5}
+#     ns4.example.com.:    {ip: [10.0.0.4], servfail: true}
+#     ns5.example.com.:    {ip: [10.0.0.5], upward: .}
+#     ns6.example.com.:
+#       ip: [10.0.0.6, 10.0.0.16]
+#       per_ip: {10.0.0.16: {records: {www.example.com.: {A: [10.1.1.6]}}}}
+#   zones:
+#     .:    {ns: [a.root-servers.net.]}
+#     com.: {ns: [a.gtld-servers.net.]}
+#     example.com.:
+#       ns: [ns1.example.com., ns2.example.com., ns3.example.com., ns4.example.com., ns5.example.com.,
+#            ns6.example.com.]
+#       lame: [ns5.example.com.]
+#       records:
+#         www.example.com.: {A: [10.1.1.1]}
+#         mail.example.com.: {CNAME: [www.example.com.]}
+#
+# Servers answer authoritatively for every zone that lists them in ns and
+# not in lame. Per server you can set:
+#
+#   ip        addresses of the server, used for glue and to route queries
+#   records   records that override the zone data, to simulate servers that
+#             are out of sync
+#   latency   seconds to wait before answering, queries with a shorter
+#             timeout time out instead
+#   loss      fraction of queries that are dropped and time out
+#   timeout   seconds to wait before reporting a dropped query
+#   servfail  answer every query with SERVFAIL
+#   upward    refer queries for zones the server doesn't serve to this zone,
+#             instead of refusing them
+#   per_ip    any of the above for one of the addresses only, to simulate
+#             servers whose addresses don't all give the same answers
+#
+# Per zone you can set ns, lame and records as above, ttl (default 3600)
+# and glue, the list of nameservers to send glue for in delegations
+# (default: all nameservers with known addresses).
+#
+# This file is distributed under the same license as tracegraph.py
+
+import collections
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import random
+import threading
+import time
+
+def absolute(name):
+    name = str(name).lower()
+    if not name.endswith('.'):
+        name += '.'
+    return name
+
+def is_below(name, zone):
+    return zone == '.' or name == zone or name.endswith('.' + zone)
+
+class FakeTransport(object):
+    def __init__(self, description, seed=0):
+        self.seed = seed
+        self.servers = {}
+        self.zones = {}
+        self.by_ip = {}
+        self.per_ip = {}
+        self.queries = collections.Counter()
+        self.attempts = collections.Counter()
+        self.lock = threading.Lock()
+
+        for name, server in (description.get('servers') or {}).items():
+            server = dict(server)
+            server['ip'] = [str(x) for x in server.get('ip', [])]
+            server['records'] = self.normalize_records(server.get('records'))
+            server['zones'] = []
+            self.servers[absolute(name)] = server
+            for ip in server['ip']:
+                self.by_ip[ip] = absolute(name)
+            for ip, override in (server.get('per_ip') or {}).items():
+                records = dict(server['records'])
+                records.update(self.normalize_records(override.get('records')))
+                self.per_ip[str(ip)] = dict(server)
+                self.per_ip[str(ip)].update(override)
+                self.per_ip[str(ip)]['records'] = records
+
+        for name, zone in (description.get('zones') or {}).items():
+            zone = dict(zone)
+            zone['name'] = absolute(name)
+            zone['ns'] = [absolute(x) for x in zone.get('ns', [])]
+            zone['lame'] = [absolute(x) for x in zone.get('lame', [])]
+            zone['glue'] = [absolute(x) for x in zone.get('glue', zone['ns'])]
+            zone['ttl'] = zone.get('ttl', 3600)
+            zone['records'] = self.normalize_records(zone.get('records'))
+            self.zones[zone['name']] = zone
+            for ns in zone['ns']:
+                if ns in self.servers and ns not in zone['lame']:
+                    self.servers[ns]['zones'].append(zone['name'])
+
+        self.root_hints = []
+        for ns in self.zones.get('.', {}).get('ns', []):
+            ips = self.servers.get(ns, {}).get('ip', [])
+            ipv4 = [x for x in ips if ':' not in x]
+            ipv6 = [x for x in ips if ':' in x]
+            self.root_hints.append((ns, ipv4 and ipv4[0] or None, ipv6 and ipv6[0] or None))
+
+    @classmethod
+    def load(klass, fd, seed=0):
+        import yaml
+        return klass(yaml.safe_load(fd), seed)
+
+    @staticmethod
+    def normalize_records(records):
+        ret = {}
+        for name, rrsets in (records or {}).items():
+            ret[absolute(name)] = dict([(rdtype.upper(), [str(x) for x in values]) for rdtype, values in rrsets.items()])
+        return ret
+
+    def query(self, ip, name, rdtype, timeout=None):
+        if isinstance(rdtype, basestring):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        qname = dns.name.from_text(name)
+        name = absolute(name)
+        with self.lock:
+            self.queries[ip] += 1
+            self.attempts[ip, name, rdtype] += 1
+            attempt = self.attempts[ip, name, rdtype]
+
+        server = self.per_ip.get(ip) or self.servers.get(self.by_ip.get(ip))
+        if not server:
+            raise dns.resolver.Timeout()
+        # Decide about packet loss based on the query itself, so the outcome
+        # doesn't depend on the order in which parallel queries arrive
+        if server.get('loss') and random.Random('%s %s %s %s %d' % (self.seed, ip, name, rdtype, attempt)).random() < server['loss']:
+            time.sleep(min(server.get('timeout', 0), timeout or server.get('timeout', 0)))
+            raise dns.resolver.Timeout()
+        if server.get('latency'):
+            if timeout and server['latency'] > timeout:
+                # The answer would come too late
+                time.sleep(timeout)
+                raise dns.resolver.Timeout()
+            time.sleep(server['latency'])
+        if server.get('servfail'):
+            raise dns.resolver.NoNameservers()
+
+        response = dns.message.make_response(dns.message.make_query(qname, rdtype))
+        self.answer(server, name, rdtype, response)
+        if response.rcode() == dns.rcode.REFUSED:
+            raise dns.resolver.NoNameservers()
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        return dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response, False)
+
+    def answer(self, server, name, rdtype, response):
+        zones = [x for x in server['zones'] if is_below(name, x)]
+        if not zones:
+            if server.get('upward'):
+                self.refer(self.zones[absolute(server['upward'])], response)
+            else:
+                response.set_rcode(dns.rcode.REFUSED)
+            return
+        zone = self.zones[max(zones, key=len)]
+
+        # Delegated further down?
+        cuts = [x for x in self.zones if x != zone['name'] and is_below(x, zone['name']) and is_below(name, x)]
+        if cuts:
+            return self.refer(self.zones[min(cuts, key=len)], response)
+
+        records = server['records'].get(name, {})
+        records = records or zone['records'].get(name, {})
+        type_ = dns.rdatatype.to_text(rdtype)
+        if name == zone['name'] and type_ == 'NS':
+            self.add(response, response.answer, name, 'NS', zone['ns'], zone['ttl'])
+            self.add_glue(zone, response)
+        elif type_ in records:
+            self.add(response, response.answer, name, type_, records[type_], zone['ttl'])
+        elif 'CNAME' in records:
+            self.add(response, response.answer, name, 'CNAME', records['CNAME'], zone['ttl'])
+        else:
+            # NODATA or NXDOMAIN, both with the SOA in the authority section
+            soa = '%s %s 1 3600 600 86400 %d' % ((zone['ns'] or [zone['name']])[0], ('hostmaster.' + zone['name']).replace('..', '.'), zone['ttl'])
+            self.add(response, response.authority, zone['name'], 'SOA', [soa], zone['ttl'])
+            exists = name == zone['name'] or [x for x in zone['records'] if is_below(x, name)]
+            if not exists:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+
+    def refer(self, zone, response):
+        self.add(response, response.authority, zone['name'], 'NS', zone['ns'], zone['ttl'])
+        self.add_glue(zone, response)
+
+    def add_glue(self, zone, response):
+        for ns in zone['glue']:
+            ips = self.servers.get(ns, {}).get('ip', [])
+            ipv4 = [x for x in ips if ':' not in x]
+            ipv6 = [x for x in ips if ':' in x]
+            if ipv4:
+                self.add(response, response.additional, ns, 'A', ipv4, zone['ttl'])
+            if ipv6:
+                self.add(response, response.additional, ns, 'AAAA', ipv6, zone['ttl'])
+
+    def add(self, response, section, name, rdtype, values, ttl):
+        rdtype = dns.rdatatype.from_text(rdtype)
+        rrset = response.find_rrset(section, dns.name.from_text(name), dns.rdataclass.IN, rdtype, create=True)
+        for value in values:
+            rrset.add(dns.rdata.from_text(dns.rdataclass.IN, rdtype, value), ttl)
@@ -1,29 +1,165 @@
 from django.core.management import BaseCommand
-from dnsgraph.models import DnsName
+from django.db import connection
+from dnsgraph.models import DnsName, background_priority, save_queue_stats
 import beanstalkc
+import collections
 from django.conf import settings
+from optparse import make_option
 import datetime
+import os
+import signal
 import sys
+import threading
+import traceback
 from os.path import dirname as d
 sys.path.insert(0,d(d(d(__file__))))
 import tracegraph
 
 class Command(BaseCommand):
     help = "Run all the DNS requests"
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', dest='workers', type='int', default=4,
+                    help="Number of traces to run at the same time"),
+        make_option('-t', '--timeout', dest='timeout', type='int', default=300,
+                    help="Give up on traces that take longer than this many seconds"),
+        make_option('-r', '--retries', dest='retries', type='int', default=1,
+                    help="Retry traces that timed out this many times before burying them"),
+        make_option('-m', '--max-queries', dest='max_queries', type='int', default=50,
+                    help="Maximum number of DNS queries in flight for all workers together"),
+        make_option('-d', '--deadline', dest='deadline', type='float', default=None,
+                    help="Stop traces after this many seconds and save what was found so far"),
+        make_option('-b', '--budget', dest='budget', type='int', default=None,
+                    help="Stop traces after this many queries and save what was found so far"),
+        make_option('--max-depth', dest='max_depth', type='int', default=None,
+                    help="Don't follow more than this many delegations, CNAMEs and other targets in a row"),
+        make_option('--max-cname-chain', dest='max_cname_chain', type='int', default=None,
+                    help="Don't follow more than this many CNAMEs in a row"),
+    )
 
     def handle(self, *args, **options):
+        self.options = options
+        self.stopping = threading.Event()
+        # How long the last jobs waited for a worker and took, for the views
+        self.waits = collections.deque(maxlen=100)
+        self.durations = collections.deque(maxlen=100)
+        self.stats_lock = threading.Lock()
+        tracegraph.default_transport.limit(options['max_queries'])
+        # Per trace, what isn't given here comes from DNSGRAPH_TRACE_LIMITS
+        self.limits = {}
+        for key, option in (('deadline', 'deadline'), ('max_queries', 'budget'), ('max_depth', 'max_depth'), ('max_cname_chain', 'max_cname_chain')):
+            if options[option] is not None:
+                self.limits[key] = options[option]
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        workers = [threading.Thread(target=self.work, name="worker-%d" % x) for x in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        # Join with a timeout, so we still get to handle signals
+        while [x for x in workers if x.is_alive()]:
+            for worker in workers:
+                worker.join(1)
+
+    def stop(self, signum, frame):
+        if self.stopping.is_set():
+            print "Stopping immediately"
+            os._exit(1)
+        print "Stopping after the running traces are done, repeat to stop immediately"
+        self.stopping.set()
+
+    def work(self):
         bs = beanstalkc.Connection(**settings.BEANSTALK_SERVER)
         bs.watch('dns-graph')
-        while True:
-            job = bs.reserve()
-            name, qtype = job.body.split()
-            print "Processing %s (%s)" % (name, qtype)
-            root = tracegraph.root()
-            root.trace(name,qtype)
-            dn = DnsName.objects.get(name=name, qtype=qtype)
-            with open(dn.data_path, 'w') as fd:
-                root.dump('yaml', fd)
-            dn.available = True
-            dn.queried_at = datetime.datetime.now()
-            dn.save()
-            job.delete()
+        try:
+            while not self.stopping.is_set():
+                job = bs.reserve(timeout=1)
+                if not job:
+                    continue
+                # Anything that goes wrong outside the trace itself, like a
+                # name that was deleted or a failing database, buries the
+                # job instead of killing this worker
+                dn = None
+                try:
+                    # All record types asked for are traced at once. Jobs
+                    # queued by older versions have the record type in them
+                    # too.
+                    dn = DnsName.objects.filter(name=job.body.split()[0])[0]
+                    self.process(job, dn)
+                except Exception:
+                    print "Processing job %d (%s) failed, burying it\n%s" % (job.jid, job.body, traceback.format_exc())
+                    try:
+                        job.bury()
+                    except beanstalkc.CommandFailed:
+                        # Already buried or deleted by process()
+                        pass
+                    if dn:
+                        dn.trace_done(job.jid)
+        finally:
+            bs.close()
+            connection.close()
+
+    def process(self, job, dn):
+        name = dn.name
+        qtypes = dn.qtypes()
+        qtype = '+'.join(qtypes)
+        print "%s: Processing %s (%s)" % (threading.current_thread().name, name, qtype)
+        started = datetime.datetime.now()
+        wait = job.stats()['age']
+        root = dn.previous_trace(**self.limits)
+        result = {}
+
+        def trace():
+            try:
+                root.refresh([name], qtypes)
+                result['done'] = True
+            except tracegraph.Cancelled:
+                pass
+            except Exception:
+                result['error'] = traceback.format_exc()
+
+        thread = threading.Thread(target=trace)
+        thread.daemon = True
+        thread.start()
+        # Keep the job reserved while we wait, beanstalk would hand it to
+        # another worker once its time-to-run is over
+        deadline = datetime.datetime.now() + datetime.timedelta(0, self.options['timeout'])
+        while thread.is_alive() and datetime.datetime.now() < deadline:
+            thread.join(10)
+            job.touch()
+
+        if thread.is_alive():
+            root.cancel()
+            # The trace stops at its next step, wait for that so it's not
+            # still running when another worker retries it
+            job.touch()
+            thread.join(30)
+            if thread.is_alive():
+                print "Trace of %s (%s) timed out and doesn't stop, burying it" % (name, qtype)
+                job.bury()
+                dn.trace_done(job.jid)
+                return
+            if job.stats()['releases'] < self.options['retries']:
+                print "Trace of %s (%s) timed out, retrying later" % (name, qtype)
+                # Let traces that people are waiting for go first
+                job.release(priority=background_priority, delay=60)
+            else:
+                print "Trace of %s (%s) timed out, burying it" % (name, qtype)
+                job.bury()
+                dn.trace_done(job.jid)
+            return
+        if 'error' in result:
+            print "Trace of %s (%s) failed, burying it\n%s" % (name, qtype, result['error'])
+            job.bury()
+            dn.trace_done(job.jid)
+            return
+
+        truncated = len([x for x in root.names.values() if tracegraph.truncated in x.addresses])
+        if truncated:
+            print "Trace of %s (%s) was cut off for %d names" % (name, qtype, truncated)
+        dn.save_trace(root, qtypes)
+        job.delete()
+        dn.trace_done(job.jid)
+        with self.stats_lock:
+            self.waits.append(wait)
+            self.durations.append((datetime.datetime.now() - started).total_seconds())
+            save_queue_stats(self.waits, self.durations)
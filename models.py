@@ -1,11 +1,73 @@
 import datetime
 from django.conf import settings
 from django.db import models
-from azuki import beanstalk
+import beanstalkc
+import fcntl
+import json
 import os
+import snapshots
+import threading
 import tracegraph
 
+if hasattr(settings, 'DNSGRAPH_IPV6'):
+    tracegraph.have_ipv6 = settings.DNSGRAPH_IPV6
+
+snapshot_store = snapshots.SnapshotStore(getattr(settings, 'DNSGRAPH_SNAPSHOTS', os.path.join(settings.STATIC_ROOT, 'dnsgraph', 'snapshots')))
+
 recordtypes = ("A", "AAAA", "MX", "PTR", "SOA", "SRV", "TXT")
+# All record types asked for for a name are traced together, and kept in one
+# trace and one snapshot history
+combined = 'ALL'
+
+# Limits for every trace, see tracegraph.root: max_queries, max_depth,
+# max_cname_chain and deadline
+trace_limits = getattr(settings, 'DNSGRAPH_TRACE_LIMITS', {})
+
+# Traces somebody is waiting for go before background refreshes and retries
+interactive_priority = 1024
+background_priority = 2 ** 31
+tube = 'dns-graph'
+queue_dir = os.path.join(settings.STATIC_ROOT, 'dnsgraph', 'queue')
+connections = threading.local()
+
+def queue():
+    if not hasattr(connections, 'beanstalk'):
+        connections.beanstalk = beanstalkc.Connection(**settings.BEANSTALK_SERVER)
+        connections.beanstalk.use(tube)
+    return connections.beanstalk
+
+def queue_stats():
+    # How many traces are waiting and running, and how long the last ones
+    # waited for a worker and took, as recorded by the daemon
+    try:
+        stats = queue().stats_tube(tube)
+    except beanstalkc.CommandFailed:
+        # Nobody has used the tube yet
+        stats = {}
+    ret = {
+        'waiting': stats.get('current-jobs-ready', 0) + stats.get('current-jobs-delayed', 0),
+        'running': stats.get('current-jobs-reserved', 0),
+        'recent': False,
+    }
+    try:
+        with open(os.path.join(queue_dir, 'stats.json')) as fd:
+            recent = json.load(fd)
+    except (IOError, ValueError):
+        return ret
+    if recent['wait']:
+        ret['recent'] = True
+        # Medians, one slow trace shouldn't scare people away
+        for key in ('wait', 'duration'):
+            ret[key] = int(round(sorted(recent[key])[len(recent[key]) // 2]))
+    return ret
+
+def save_queue_stats(waits, durations):
+    if not os.path.exists(queue_dir):
+        os.makedirs(queue_dir)
+    path = os.path.join(queue_dir, 'stats.json')
+    with open(path + '.tmp', 'w') as fd:
+        json.dump({'wait': list(waits), 'duration': list(durations)}, fd)
+    os.rename(path + '.tmp', path)
 
 class DnsName(models.Model):
     name = models.CharField("DNS Name", max_length=100)
@@ -15,26 +77,125 @@ class DnsName(models.Model):
 
     @property
     def data_path(self):
-        return os.path.join(settings.STATIC_ROOT, 'dnsgraph', "%s-%s.yaml" % (self.name.replace('.', '_'), self.qtype))
+        return os.path.join(settings.STATIC_ROOT, 'dnsgraph', "%s-%s.jsonl" % (self.name.replace('.', '_'), combined))
+
+    @property
+    def index_path(self):
+        return os.path.join(settings.STATIC_ROOT, 'dnsgraph', "%s-%s.index.json" % (self.name.replace('.', '_'), combined))
+
+    @property
+    def key(self):
+        # Where this record type's answers are in the trace
+        return tracegraph.name_key(self.name.rstrip('.') + '.', self.qtype)
+
+    def qtypes(self):
+        qtypes = set(DnsName.objects.filter(name=self.name).values_list('qtype', flat=True)) | set([self.qtype])
+        return [x for x in recordtypes if x in qtypes]
 
-    def maybe_trace(self):
+    def previous_trace(self, **limits):
+        # Start from the last trace, so only what has expired since needs to
+        # be queried again
+        limits = dict(trace_limits, **limits)
+        if os.path.exists(self.data_path):
+            try:
+                with open(self.data_path) as fd:
+                    tree = tracegraph.Zone.load('jsonl', fd)
+                return tracegraph.root(stats=True, tree=tree, **limits)
+            except ValueError:
+                # Written by an older version
+                pass
+        return tracegraph.root(stats=True, **limits)
+
+    def index(self):
+        # What's in the trace, without reading all of it
+        try:
+            # Unless the trace was written without one, by an older version
+            # or by hand
+            if os.path.getmtime(self.index_path) >= os.path.getmtime(self.data_path):
+                with open(self.index_path) as fd:
+                    index = json.load(fd)
+                if index['version'] == tracegraph.Journal.version:
+                    return index
+        except (OSError, IOError, ValueError, KeyError):
+            pass
+        if not os.path.exists(self.data_path):
+            return None
+        with open(self.data_path) as fd:
+            dump = tracegraph.LazyDump(fd)
+        return self.save_index(dump.tree(), dump.stats())
+
+    def save_index(self, root, stats=None):
+        index = root.index()
+        index['stats'] = index['stats'] or stats
+        with open(self.index_path + '.tmp', 'w') as fd:
+            json.dump(index, fd)
+        os.rename(self.index_path + '.tmp', self.index_path)
+        return index
+
+    def maybe_trace(self, priority=interactive_priority):
         # Only once per 15 minutes...
         if self.available and self.queried_at and self.queried_at > datetime.datetime.now() - datetime.timedelta(0,900):
             if os.path.exists(self.data_path):
                 return
         self.available = False
         self.save()
-        self.trace()
+        self.trace(priority)
 
-    @beanstalk('dns-graph')
-    def trace(self):
-        if self.available and self.queried_at and self.queried_at > datetime.datetime.now() - datetime.timedelta(0,900):
-            if os.path.exists(self.data_path):
-                return
-        root = tracegraph.root()
-        root.trace(self.name, self.qtype)
-        with open(self.data_path, 'w') as fd:
-            root.dump('yaml', fd)
+    @property
+    def job_path(self):
+        return os.path.join(queue_dir, self.name.replace('.', '_'))
+
+    def trace(self, priority=interactive_priority):
+        # Queue a trace for the daemon, unless one is queued or running
+        # already: then whoever asks gets that one. Waiting traces, including
+        # retries the daemon delayed, are queued again if somebody needs them
+        # sooner. A trace is for all record types of a name.
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        bs = queue()
+        with open(self.job_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.job_path) as fd:
+                    jid = int(fd.read())
+                job = bs.stats_job(jid)
+            except (IOError, ValueError, beanstalkc.CommandFailed):
+                job = None
+            if job and job['state'] != 'buried':
+                if job['state'] == 'reserved' or job['pri'] <= priority:
+                    return jid
+                try:
+                    bs.delete(jid)
+                except beanstalkc.CommandFailed:
+                    # A worker got to it first
+                    return jid
+            jid = bs.put(str(self.name), priority=priority)
+            with open(self.job_path, 'w') as fd:
+                fd.write(str(jid))
+            return jid
+
+    def trace_done(self, jid):
+        # Called by the daemon when it is done with a job
+        try:
+            with open(self.job_path) as fd:
+                if int(fd.read()) != jid:
+                    return
+            os.unlink(self.job_path)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def save_trace(self, root, qtypes=None):
+        # The views may be reading the previous trace
+        with open(self.data_path + '.tmp', 'w') as fd:
+            root.dump('jsonl', fd)
+        os.rename(self.data_path + '.tmp', self.data_path)
+        self.save_index(root)
+        # And keep it in the history
+        snapshot_store.save(root, self.name.rstrip('.') + '.', combined)
         self.available = True
         self.queried_at = datetime.datetime.now()
         self.save()
+        DnsName.objects.filter(name=self.name, qtype__in=qtypes or [self.qtype]).update(available=True, queried_at=self.queried_at)
+
+    def snapshots(self):
+        return snapshot_store.history(self.name.rstrip('.') + '.', combined)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# A content-addressed store for tracegraph traces, keeping the history of
+# every traced name
+#
+# ./snapshots.py -h gives you help output
+#
+# A snapshot is stored as separate objects for every zone and every name in
+# it, named by the SHA-1 of their contents, like git does. Zones refer to the
+# zones their nameservers were delegated from by hash, so a zone object
+# stands for the whole delegation path down to it. Identical zones, like the
+# root and com., are stored once for all traces and all points in time, and
+# two snapshots can be compared by comparing hashes. When delegations and
+# answers expire is recorded per snapshot, not in the shared objects.
+#
+#   objects/ab/cdef...            zone, name and snapshot objects
+#   history/<name>/<rdtype>       "time hash" lines, one per snapshot
+#
+# This file is distributed under the same license as tracegraph.py
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import tracegraph
+
+class SnapshotStore(object):
+    def __init__(self, path, cache_size=1000):
+        self.path = path
+        # Parsed objects, shared zones are needed by almost every snapshot
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def object_path(self, hash):
+        return os.path.join(self.path, 'objects', hash[:2], hash[2:])
+
+    def history_path(self, name, rdtype):
+        return os.path.join(self.path, 'history', name.rstrip('.') or '.', rdtype)
+
+    def put(self, obj):
+        data = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+        hash = hashlib.sha1(data).hexdigest()
+        path = self.object_path(hash)
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Somebody else made it first
+                    pass
+            tmp = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+            with open(tmp, 'wb') as fd:
+                fd.write(zlib.compress(data))
+            os.rename(tmp, path)
+        return hash
+
+    def get(self, hash):
+        with self.lock:
+            if hash in self.cache:
+                self.cache[hash] = self.cache.pop(hash)
+                return self.cache[hash]
+        with open(self.object_path(hash), 'rb') as fd:
+            obj = json.loads(zlib.decompress(fd.read()))
+        with self.lock:
+            self.cache[hash] = obj
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return obj
+
+    def save(self, root, name, rdtype):
+        data = root.serialize()
+        zones = {}
+        expires = {'zones': {}, 'names': {}}
+        # serialize() puts zones after the zones they were delegated from
+        for zone in [data] + data['zones']:
+            if zone.get('expires'):
+                expires['zones'][zone['name']] = zone['expires']
+            # Round-robin glue comes in any order, that's no change
+            resolvers = [{'name': x['name'], 'ip': sorted(x['ip']), 'up': sorted(x['up'])} for x in zone['resolvers']]
+            resolvers.sort(key=lambda x: x['name'])
+            parents = set([up[0] for x in resolvers for up in x['up'] if up[0] != zone['name']])
+            zones[zone['name']] = self.put({
+                'type': 'zone',
+                'name': zone['name'],
+                'resolvers': resolvers,
+                'parents': dict([(x, zones.get(x)) for x in parents]),
+            })
+        names = {}
+        for name_ in data['names']:
+            key = tracegraph.name_key(name_['name'], name_.get('rdtype'))
+            if name_.get('expires'):
+                expires['names'][key] = name_.pop('expires')
+            name_['type'] = 'name'
+            name_['addresses'] = dict([(x, sorted(y)) for x, y in name_['addresses'].items()])
+            if 'via' in name_:
+                name_['via'] = [x[:3] + [sorted(x[3])] for x in name_['via']]
+            names[key] = self.put(name_)
+        snapshot = {
+            'type': 'snapshot',
+            'name': name,
+            'rdtype': rdtype,
+            'time': time.time(),
+            'zones': zones,
+            'names': names,
+            'expires': expires,
+        }
+        if data.get('stats'):
+            snapshot['stats'] = data['stats']
+        hash = self.put(snapshot)
+
+        path = self.history_path(name, rdtype)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        with open(path, 'a') as fd:
+            fd.write("%f %s\n" % (snapshot['time'], hash))
+        return hash
+
+    def history(self, name, rdtype):
+        # [(time, hash), ...], oldest first
+        path = self.history_path(name, rdtype)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fd:
+            return [(float(x.split()[0]), x.split()[1]) for x in fd if x.strip()]
+
+    def latest(self, name, rdtype):
+        history = self.history(name, rdtype)
+        return history and history[-1][1] or None
+
+    def load(self, hash):
+        snapshot = self.get(hash)
+        zones = dict([(x, self.get(y)) for x, y in snapshot['zones'].items()])
+        data = {'name': '.', 'resolvers': [], 'zones': [], 'names': []}
+        done = set()
+        # Zones have to come after the zones they were delegated from
+        def add_zone(name):
+            if name in done or name not in zones:
+                return
+            done.add(name)
+            for parent in sorted(zones[name]['parents']):
+                add_zone(parent)
+            zone = {'name': name, 'resolvers': zones[name]['resolvers'], 'zones': [], 'names': []}
+            if name in snapshot['expires']['zones']:
+                zone['expires'] = snapshot['expires']['zones'][name]
+            if name == '.':
+                data['resolvers'] = zone['resolvers']
+            else:
+                data['zones'].append(zone)
+        for name in sorted(zones):
+            add_zone(name)
+        for name, hash_ in snapshot['names'].items():
+            name_ = dict(self.get(hash_))
+            if name in snapshot['expires']['names']:
+                name_['expires'] = snapshot['expires']['names'][name]
+            data['names'].append(name_)
+        return tracegraph.Zone.deserialize(data)
+
+    def diff(self, old, new):
+        # What changed between two snapshots: zones and names that appeared
+        # or disappeared, nameservers that appeared, disappeared or changed,
+        # and answers that appeared or disappeared. Returns (change, what,
+        # key, detail) tuples, change is one of +, - and ~.
+        old, new = self.get(old), self.get(new)
+        ret = []
+        for zone in sorted(set(old['zones']) | set(new['zones'])):
+            if old['zones'].get(zone) == new['zones'].get(zone):
+                continue
+            if zone not in new['zones']:
+                ret.append(('-', 'zone', zone, None))
+                continue
+            if zone not in old['zones']:
+                ret.append(('+', 'zone', zone, None))
+                continue
+            # Changed, or only one of the zones above it changed
+            old_ = dict([(x['name'], x) for x in self.get(old['zones'][zone])['resolvers']])
+            new_ = dict([(x['name'], x) for x in self.get(new['zones'][zone])['resolvers']])
+            for ns in sorted(set(old_) | set(new_)):
+                if ns not in new_:
+                    ret.append(('-', 'nameserver', zone, ns))
+                elif ns not in old_:
+                    ret.append(('+', 'nameserver', zone, ns))
+                else:
+                    if set(old_[ns]['ip']) != set(new_[ns]['ip']):
+                        ret.append(('~', 'address', zone, '%s: %s -> %s' % (ns, ', '.join(sorted(old_[ns]['ip'])), ', '.join(sorted(new_[ns]['ip'])))))
+                    for up in sorted(set(map(tuple, old_[ns]['up'])) ^ set(map(tuple, new_[ns]['up']))):
+                        change = list(up) in old_[ns]['up'] and '-' or '+'
+                        ret.append((change, 'delegation', zone, '%s by %s' % (ns, up[1])))
+        for name in sorted(set(old['names']) | set(new['names'])):
+            if old['names'].get(name) == new['names'].get(name):
+                continue
+            if name not in new['names']:
+                ret.append(('-', 'name', name, None))
+                continue
+            if name not in old['names']:
+                ret.append(('+', 'name', name, None))
+                continue
+            old_, new_ = self.get(old['names'][name]), self.get(new['names'][name])
+            answers = lambda x: set([(address, zone, ns) for address in x['addresses'] for zone, ns in x['addresses'][address]])
+            for address, zone, ns in sorted(answers(old_) - answers(new_)):
+                ret.append(('-', 'answer', name, '%s from %s' % (address, ns)))
+            for address, zone, ns in sorted(answers(new_) - answers(old_)):
+                ret.append(('+', 'answer', name, '%s from %s' % (address, ns)))
+        return ret
+
+def format_diff(diff):
+    return ["%s %s %s%s" % (change, what, key, detail and ': ' + detail or '') for change, what, key, detail in diff]
+
+if __name__ == '__main__':
+    import optparse
+    import sys
+
+    usage = """%prog [options] command [arguments] - Keep the history of tracegraph traces
+
+Commands:
+save DUMP NAME [TYPE]   Save a trace dumped by tracegraph.py (in jsonl format)
+log NAME [TYPE]         Show all snapshots of a name
+show HASH DUMP          Write a snapshot as a jsonl dump that tracegraph.py can load
+diff OLD NEW            Show what changed between two snapshots
+
+Examples:
+tracegraph.py kaarsemaker.net --dump=kaarsemaker.jsonl --format=jsonl
+%prog --store /var/lib/dnsgraph save kaarsemaker.jsonl kaarsemaker.net
+%prog --store /var/lib/dnsgraph log kaarsemaker.net"""
+
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('-s', '--store', dest='store', default='.', metavar='DIR',
+                 help="Directory the snapshots are stored in")
+    opts, args = p.parse_args()
+    if not args:
+        p.error("No command given")
+
+    store = SnapshotStore(opts.store)
+    command, args = args[0], args[1:]
+    name = lambda x: x.endswith('.') and x or x + '.'
+    if command == 'save' and len(args) in (2, 3):
+        with open(args[0]) as fd:
+            root = tracegraph.Zone.load('jsonl', fd)
+        print(store.save(root, name(args[1]), (args[2:] or ['A'])[0]))
+    elif command == 'log' and len(args) in (1, 2):
+        for when, hash in reversed(store.history(name(args[0]), (args[1:] or ['A'])[0])):
+            print("%s %s" % (hash, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))))
+    elif command == 'show' and len(args) == 2:
+        with open(args[1], 'w') as fd:
+            store.load(args[0]).dump('jsonl', fd)
+    elif command == 'diff' and len(args) == 2:
+        for line in format_diff(store.diff(args[0], args[1])):
+            print(line)
+    else:
+        p.error("Unknown command or wrong number of arguments")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Tests for tracegraph, run against the fake DNS hierarchy from fakedns.py so
+# they need no network access:
+#
+#   python -m unittest tests
+#
+# This file is distributed under the same license as tracegraph.py
+
+import copy
+import dns.resolver
+import fakedns
+import shutil
+import snapshots
+import tempfile
+import tracegraph
+import unittest
+
+tracegraph.log = lambda x: None
+tracegraph.have_ipv6 = False
+
+WORLD = {
+    'servers': {
+        'a.root-servers.net.': {'ip': ['198.41.0.4']},
+        'a.gtld-servers.net.': {'ip': ['192.5.6.30']},
+        'ns1.example.com.': {'ip': ['10.0.0.1']},
+        'ns2.example.com.': {'ip': ['10.0.0.2']},
+    },
+    'zones': {
+        '.': {'ns': ['a.root-servers.net.']},
+        'com.': {'ns': ['a.gtld-servers.net.']},
+        'example.com.': {
+            'ns': ['ns1.example.com.', 'ns2.example.com.'],
+            'records': {
+                'www.example.com.': {'A': ['10.1.1.1']},
+            },
+        },
+    },
+}
+
+def world(servers={}, zones={}):
+    # The world above, with some servers and zones changed or added
+    ret = copy.deepcopy(WORLD)
+    for name, server in servers.items():
+        ret['servers'].setdefault(name, {}).update(server)
+    for name, zone in zones.items():
+        ret['zones'].setdefault(name, {}).update(zone)
+    return ret
+
+def trace(transport, name, rdtype='A', **kwargs):
+    root = tracegraph.root(transport=transport, live=True, **kwargs)
+    root.trace(name, rdtype)
+    return root
+
+def answers(root, key):
+    # Answers as (address, nameservers) pairs
+    name = root.names[key]
+    return sorted([(address, sorted([x.name for x in name.addresses[address]])) for address in name.addresses])
+
+class FakeTransportTest(unittest.TestCase):
+    def test_per_ip(self):
+        transport = fakedns.FakeTransport(world({'ns1.example.com.': {'ip': ['10.0.0.1', '10.0.0.11'],
+            'per_ip': {'10.0.0.11': {'records': {'www.example.com.': {'A': ['10.1.1.9']}}}}}}))
+        root = trace(transport, 'www.example.com', all_addresses=True)
+        name = root.names['www.example.com.']
+        self.assertEqual(sorted(name.addresses), ['10.1.1.1', '10.1.1.9'])
+        via = dict([(address, ips) for (address, resolver), ips in name.via.items() if resolver.name == 'ns1.example.com.'])
+        self.assertEqual(via, {'10.1.1.1': ['10.0.0.1'], '10.1.1.9': ['10.0.0.11']})
+
+    def test_latency(self):
+        transport = fakedns.FakeTransport(world({'ns1.example.com.': {'latency': 0.05}}))
+        self.assertRaises(dns.resolver.Timeout, transport.query, '10.0.0.1', 'www.example.com.', 'A', 0.01)
+        answer = transport.query('10.0.0.1', 'www.example.com.', 'A', 0.5)
+        self.assertEqual([x.address for x in answer], ['10.1.1.1'])
+
+class RefreshTest(unittest.TestCase):
+    def test_recovered_server(self):
+        transport = fakedns.FakeTransport(world({'ns2.example.com.': {'servfail': True}}))
+        root = trace(transport, 'www.example.com')
+        self.assertEqual(answers(root, 'www.example.com.'), [('10.1.1.1', ['ns1.example.com.']), ('SERVFAIL', ['ns2.example.com.'])])
+
+        # The answer of ns1 hasn't expired, but the error of ns2 isn't reused
+        transport.servers['ns2.example.com.']['servfail'] = False
+        transport.queries.clear()
+        root.refresh(['www.example.com'])
+        self.assertEqual(answers(root, 'www.example.com.'), [('10.1.1.1', ['ns1.example.com.', 'ns2.example.com.'])])
+        # Delegations are reused
+        self.assertEqual(sorted(transport.queries), ['10.0.0.1', '10.0.0.2'])
+
+class UpwardReferralTest(unittest.TestCase):
+    def test_root(self):
+        transport = fakedns.FakeTransport(world({'ns2.example.com.': {'upward': '.'}},
+                                                {'example.com.': {'lame': ['ns2.example.com.']}}))
+        root = trace(transport, 'www.example.com')
+        self.assertEqual(answers(root, 'www.example.com.'), [('10.1.1.1', ['ns1.example.com.']), ('UPWARD REFERRAL', ['ns2.example.com.'])])
+        self.assertEqual(sorted(root.subzones), ['com.', 'example.com.'])
+        self.assertIn((tracegraph.Inconsistency.UPWARD_REFERRAL, 'ns2.example.com.'), [(x.kind, x.server) for x in root.inconsistencies()])
+
+    def test_parent(self):
+        transport = fakedns.FakeTransport(world({'ns2.example.com.': {'upward': 'com.'}},
+                                                {'example.com.': {'lame': ['ns2.example.com.']}}))
+        root = trace(transport, 'www.example.com')
+        self.assertEqual(answers(root, 'www.example.com.'), [('10.1.1.1', ['ns1.example.com.']), ('UPWARD REFERRAL', ['ns2.example.com.'])])
+        self.assertEqual(sorted(root.subzones), ['com.', 'example.com.'])
+
+class NodataTest(unittest.TestCase):
+    def test_several_rdtypes(self):
+        root = trace(fakedns.FakeTransport(world()), 'www.example.com', ['A', 'MX'])
+        self.assertEqual(answers(root, 'www.example.com. A'), [('10.1.1.1', ['ns1.example.com.', 'ns2.example.com.'])])
+        self.assertEqual(answers(root, 'www.example.com. MX'), [('NODATA', ['ns1.example.com.', 'ns2.example.com.'])])
+        self.assertTrue(root.names['www.example.com. MX'].expires)
+        self.assertEqual(root.inconsistencies(), [])
+        self.assertEqual(root.index()['errors'], {})
+
+    def test_disagreement(self):
+        transport = fakedns.FakeTransport(world({'ns2.example.com.': {'records': {'www.example.com.': {'A': ['10.1.1.1'], 'AAAA': ['fd00::1']}}}}))
+        root = trace(transport, 'www.example.com', ['A', 'AAAA'])
+        self.assertEqual(answers(root, 'www.example.com. AAAA'), [('NODATA', ['ns1.example.com.']), ('fd00::1', ['ns2.example.com.'])])
+        self.assertEqual(sorted([(x.kind, x.server, x.address) for x in root.inconsistencies()]),
+                         [(tracegraph.Inconsistency.MISSING_ANSWER, 'ns1.example.com.', 'fd00::1'),
+                          (tracegraph.Inconsistency.MISSING_ANSWER, 'ns2.example.com.', 'NODATA')])
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = snapshots.SnapshotStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def snapshot(self, servers):
+        root = trace(fakedns.FakeTransport(world(servers)), 'www.example.com')
+        return self.store.save(root, 'www.example.com.', 'A')
+
+    def test_glue_order(self):
+        old = self.snapshot({'ns1.example.com.': {'ip': ['10.0.0.1', '10.0.0.11']}})
+        new = self.snapshot({'ns1.example.com.': {'ip': ['10.0.0.11', '10.0.0.1']}})
+        self.assertEqual(self.store.get(old)['zones'], self.store.get(new)['zones'])
+        self.assertEqual(self.store.get(old)['names'], self.store.get(new)['names'])
+        self.assertEqual(self.store.diff(old, new), [])
+
+    def test_changed_address(self):
+        old = self.snapshot({})
+        new = self.snapshot({'ns2.example.com.': {'ip': ['10.0.0.12']}})
+        # Only the zone that changed gets a new hash
+        old_, new_ = self.store.get(old)['zones'], self.store.get(new)['zones']
+        self.assertEqual([x for x in sorted(old_) if old_[x] != new_[x]], ['example.com.'])
+        self.assertEqual(self.store.diff(old, new), [('~', 'address', 'example.com.', 'ns2.example.com.: 10.0.0.2 -> 10.0.0.12')])
+
+if __name__ == '__main__':
+    unittest.main()
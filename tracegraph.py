@@ -22,10 +22,20 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
 # OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import collections
+import contextlib
 import dns.resolver
+import heapq
+import itertools
+import json
+import Queue
+import random
+import re
 import socket
 import sys
-from whelk import shell, pipe
+import threading
+import time
+import weakref
 
 __dot_formats = (
     'bmp', 'canon', 'dot', 'xdot', 'cmap', 'eps', 'fig', 'gd', 'gd2', 'gif',
@@ -36,47 +46,238 @@ __dot_formats = (
 
 log = lambda x: sys.stderr.write(x + "\n")
 
-# Try creating a dummy socket to see if ipv6 is available
-have_ipv6 = True
-s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-try:
-    s.connect(('ipv6.google.com', 0))
-except:
-    have_ipv6 = False
+# Root hints, as published on https://www.internic.net/domain/named.root
+root_hints = (
+    ('a.root-servers.net.', '198.41.0.4', '2001:503:ba3e::2:30'),
+    ('b.root-servers.net.', '170.247.170.2', '2801:1b8:10::b'),
+    ('c.root-servers.net.', '192.33.4.12', '2001:500:2::c'),
+    ('d.root-servers.net.', '199.7.91.13', '2001:500:2d::d'),
+    ('e.root-servers.net.', '192.203.230.10', '2001:500:a8::e'),
+    ('f.root-servers.net.', '192.5.5.241', '2001:500:2f::f'),
+    ('g.root-servers.net.', '192.112.36.4', '2001:500:12::d0d'),
+    ('h.root-servers.net.', '198.97.190.53', '2001:500:1::53'),
+    ('i.root-servers.net.', '192.36.148.17', '2001:7fe::53'),
+    ('j.root-servers.net.', '192.58.128.30', '2001:503:c27::2:30'),
+    ('k.root-servers.net.', '193.0.14.129', '2001:7fd::1'),
+    ('l.root-servers.net.', '199.7.83.42', '2001:500:9f::42'),
+    ('m.root-servers.net.', '202.12.27.33', '2001:dc3::35'),
+)
+
+# Whether nameservers can be reached over IPv6. None means that this is
+# checked the first time it matters, set it to True or False to skip that.
+have_ipv6 = None
+have_ipv6_lock = threading.Lock()
+
+def ipv6_available():
+    global have_ipv6
+    with have_ipv6_lock:
+        if have_ipv6 is None:
+            # Connecting a UDP socket sends nothing, it only needs a route
+            try:
+                s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                try:
+                    s.connect((root_hints[0][2], 53))
+                finally:
+                    s.close()
+                have_ipv6 = True
+            except socket.error:
+                have_ipv6 = False
+    return have_ipv6
 
-if have_ipv6:
-    rdtypes_for_nameservers = [dns.rdatatype.A, dns.rdatatype.AAAA]
-else:
-    rdtypes_for_nameservers = [dns.rdatatype.A]
+def nameserver_rdtypes():
+    if ipv6_available():
+        return (dns.rdatatype.A, dns.rdatatype.AAAA)
+    return (dns.rdatatype.A,)
+
+# Result of the last priming query per transport, shared by all traces in
+# this process that use it
+primed_roots = weakref.WeakKeyDictionary()
+primed_root_lock = threading.Lock()
 
 dns_errors = {
     dns.resolver.NXDOMAIN: 'NXDOMAIN',
     dns.resolver.NoNameservers: 'SERVFAIL',
     dns.resolver.Timeout: 'TIMEOUT',
     'NODATA': 'NODATA',
+    'UPWARD': 'UPWARD REFERRAL',
 }
 
+# The answer for names whose trace was cut off by one of the root's limits,
+# see Scheduler. It's not an error, we just don't know.
+truncated = 'TRUNCATED'
+
+all_errors = frozenset(dns_errors.values())
+typed_errors = all_errors - set([dns_errors['NODATA']])
+
+class Cancelled(Exception):
+    pass
+
 class Zone(object):
+    # Trees of bulk traces contain many zones, nameservers and names, so they
+    # don't get a __dict__. Only the root zone has the attributes from
+    # subzones on.
+    __slots__ = ('name', 'resolvers', 'root', 'expires', 'trace_missing_glue', 'even_trace_m_gtld_servers_net',
+                 'concurrency', 'prime', 'all_addresses', 'subzones', 'names', 'answers', 'inflight', 'unclaimed',
+                 'saved', 'lock', 'cache', 'rtt', 'transport', 'journal', 'cancelled', 'deadline', 'stats',
+                 'order', 'dedupe', 'max_queries', 'max_depth', 'max_cname_chain', 'scheduler', 'prefetcher')
+
     def __init__(self, name, parent=None):
-        self.name = name
+        self.name = interned(name)
         self.resolvers = {}
         self.root = parent or self
+        # When the delegation to this zone expires
+        self.expires = None
         self.trace_missing_glue = parent and parent.trace_missing_glue or False
         self.even_trace_m_gtld_servers_net = parent and parent.even_trace_m_gtld_servers_net or False
+        self.concurrency = parent and parent.concurrency or 10
+        self.prime = parent and parent.prime or False
+        self.all_addresses = parent and parent.all_addresses or False
 
         if name == '.':
             self.subzones = {}
             self.names = {}
+            self.answers = {}
+            self.inflight = {}
+            self.unclaimed = set()
+            self.saved = 0
+            self.lock = threading.Lock()
+            self.prefetcher = None
+            self.cache = query_cache
+            self.rtt = rtt_tracker
+            self.transport = default_transport
+            self.journal = None
+            self.cancelled = False
+            self.deadline = None
+            self.stats = None
+            # How traces are run, see Scheduler
+            self.order = 'dfs'
+            self.dedupe = False
+            self.max_queries = None
+            self.max_depth = None
+            self.max_cname_chain = None
+            self.scheduler = None
 
     def trace(self, name, rdtype=dns.rdatatype.A):
-        if isinstance(rdtype,basestring):
-            rdtype = dns.rdatatype.from_text(rdtype)
-        if self.name == '.' and not self.resolvers:
-            self.find_root_resolvers()
+        # rdtype can be a list of rdtypes: delegations are then followed once
+        # and the nameservers that know the name are asked about all of them
         if not name.endswith('.'):
             name += '.'
-        for resolver in sorted(self.resolvers.values(), key=lambda x: x.name):
-            resolver.resolve(name, rdtype=rdtype)
+        self.forget_answers()
+        try:
+            Scheduler(self.root).run(Task(Task.TRACE, self, name, rdtype, typed=isinstance(rdtype, (list, tuple, set)) or None))
+        finally:
+            self.stop_prefetching()
+
+    def forget_answers(self):
+        # Every query is sent only once per trace, the next trace asks again:
+        # refresh() forgets what expired so it is asked again. Traces started
+        # from within a trace share its answers.
+        if self.root.scheduler:
+            return
+        with self.root.lock:
+            self.root.answers.clear()
+            self.root.unclaimed.clear()
+
+    def stop_prefetching(self):
+        # The threads that send queries are reused for the whole trace and
+        # stop when it's done
+        if self.root.scheduler or not self.root.prefetcher:
+            return
+        self.root.prefetcher.stop()
+
+    def trace_step(self, task):
+        if self.name == '.' and not self.resolvers:
+            self.find_root_resolvers()
+        resolvers = sorted(self.resolvers.values(), key=lambda x: x.name)
+        # Ask all nameservers at once, but process the answers in the same
+        # order as a serial trace would, so the tree is built identically.
+        resolvers_ = [x for x in resolvers if x.ip and x.ip != ['NODATA']]
+        if self.root.all_addresses:
+            queries = [(ip, task.name, task.rdtype) for x in resolvers_ for ip in x.ip]
+        else:
+            queries = [(x.ip[0], task.name, task.rdtype) for x in resolvers_]
+        self.root.prefetch(self.root.scheduler.budget(queries))
+        self.root.scheduler.add([Task(Task.NAMESERVER, self, task.name, task.rdtypes, resolver) for resolver in resolvers])
+
+    def trace_names(self, names, rdtype=dns.rdatatype.A):
+        # Delegations are the same for every name in a zone, so once a zone
+        # is known, further names in it are traced from that zone instead of
+        # walking all the way down from the root again. The names share one
+        # scheduler, and with that its limits.
+        self.forget_answers()
+        scheduler = Scheduler(self.root)
+        try:
+            for name in names:
+                if not name.endswith('.'):
+                    name += '.'
+                zone = self.root
+                for zonename in self.root.subzones:
+                    if (name == zonename or name.endswith('.' + zonename)) and len(zonename) > len(zone.name):
+                        zone = self.root.subzones[zonename]
+                scheduler.run(Task(Task.TRACE, zone, name, rdtype, if_unknown=True, typed=isinstance(rdtype, (list, tuple, set)) or None))
+                if self.root.journal:
+                    self.root.journal.flush()
+        finally:
+            self.stop_prefetching()
+
+    def refresh(self, names, rdtype=dns.rdatatype.A):
+        # Trace names again, but only query what has expired since the last
+        # trace: zones whose delegation expired are forgotten together with
+        # everything below them, as are names whose answers expired or came
+        # from forgotten nameservers. The rest is reused, except for errors:
+        # names that got one from any nameserver are traced again too.
+        now = time.time()
+        stale = set([x for x in self.root.subzones.values() if not x.expires or x.expires <= now])
+        todo = True
+        while todo:
+            todo = [x for x in self.root.subzones.values() if x not in stale and
+                    [up for resolver in x.resolvers.values() for up in resolver.up if up.zone in stale]]
+            stale.update(todo)
+        stale_names = set([x for x in self.root.names.values() if not x.expires or x.expires <= now or
+                           [address for address in x.addresses if address in x.errors or address == truncated] or
+                           [ns for address in x.addresses for ns in x.addresses[address] if ns.zone in stale]])
+        # Names pointing at forgotten names (CNAME, MX, SRV) need to be traced again too
+        todo = True
+        while todo:
+            forgotten = set([x.name for x in stale_names])
+            todo = [x for x in self.root.names.values() if x not in stale_names and [a for a in x.addresses if a in forgotten]]
+            stale_names.update(todo)
+
+        log("Refreshing %d of %d zones and %d of %d names" % (len(stale), len(self.root.subzones), len(stale_names), len(self.root.names)))
+        for zone in stale:
+            del self.root.subzones[zone.name]
+        for name in stale_names:
+            del self.root.names[name.key]
+        self.trace_names(names, rdtype)
+
+    def subtree(self, names):
+        # The names and zones involved in resolving the given names: their
+        # CNAME/MX/SRV targets and every zone on the way down from the root.
+        todo = [normalized_key(x) for x in names]
+        by_name = keys_by_name(self.root.names)
+        names = set()
+        resolvers = []
+        while todo:
+            name = todo.pop()
+            if name in names:
+                continue
+            if name not in self.root.names:
+                # Traced for several rdtypes
+                todo += by_name.get(name, [])
+                continue
+            names.add(name)
+            for address in self.root.names[name].addresses:
+                resolvers += self.root.names[name].addresses[address]
+                todo.append(address)
+        zones = {}
+        while resolvers:
+            zone = resolvers.pop().zone
+            if zone.name in zones:
+                continue
+            zones[zone.name] = zone
+            for resolver in zone.resolvers.values():
+                resolvers += resolver.up
+        return names, zones.values()
 
     def resolve(self, name, rdtype=dns.rdatatype.A):
         if self.name == '.' and not self.resolvers:
@@ -86,67 +287,308 @@ class Zone(object):
         if name in self.resolvers:
             # Misconfiguration a la otenet.gr, ns1.otenet.gr isn't glued anywhere. www.cosmote.gr A lookup triggered it
             pass
-        for resolver in self.resolvers.values():
-            if resolver.ip:
-                return resolver.resolve(name, rdtype=rdtype, register=False)
-        else:
+        resolvers = [x for x in self.resolvers.values() if x.ip and x.ip != ['NODATA']]
+        if not resolvers:
             # No glue at all
             return self.resolvers.values()[0].resolve(name, rdtype=rdtype, register=False)
+        # Fastest nameserver first, and move on to the next one if it doesn't answer
+        resolvers.sort(key=lambda x: (min([self.root.rtt.score(ip) for ip in x.ip]), x.name))
+        for resolver in resolvers:
+            result = resolver.resolve(name, rdtype=rdtype, register=False)
+            if result is not None:
+                return result
+
+    def prefetch(self, queries):
+        # Only the network round-trips happen in other threads, all updates
+        # to the tree are done by the thread that consumes the results.
+        # Queries that are still being sent when their answer is needed are
+        # waited for by fetch().
+        if self.root is not self:
+            return self.root.prefetch(queries)
+        if self.concurrency < 2:
+            return
+        with self.lock:
+            todo = [key for key in unique(queries) if key not in self.answers and key not in self.inflight and key not in self.unclaimed]
+            if len(todo) < 2:
+                return
+            self.unclaimed.update(todo)
+            if not self.prefetcher:
+                self.prefetcher = Prefetcher(self)
+        self.prefetcher.put(todo)
+
+    def query(self, ip, name, rdtype, adaptive=False):
+        # Adaptive queries give up as soon as the nameserver is slower than
+        # usual, for lookups that can try another nameserver. Answers that
+        # end up in the tree wait as long as the transport would.
+        if self.root is not self:
+            return self.root.query(ip, name, rdtype, adaptive)
+        if self.cancelled:
+            raise Cancelled()
+        if self.out_of_time():
+            raise Cancelled("the deadline passed")
+        key = (ip, name, rdtype)
+        if self.scheduler and not self.scheduler.budget([key]):
+            raise Cancelled("the trace made %d queries already" % self.max_queries)
+        with self.lock:
+            if key in self.unclaimed:
+                # Prefetched on our behalf, that's not a saved query
+                self.unclaimed.discard(key)
+            elif key in self.answers or key in self.inflight:
+                self.saved += 1
+        result = self.fetch(key, adaptive)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fetch(self, key, adaptive=False):
+        # Every distinct query is only sent once per trace: answers are
+        # remembered, and asking for something that is already being asked
+        # waits for that answer instead of sending the same query again.
+        with self.lock:
+            if key in self.answers:
+                return self.answers[key]
+            event = self.inflight.get(key)
+            if not event:
+                self.inflight[key] = threading.Event()
+        if event:
+            event.wait()
+            return self.answers[key]
+        try:
+            result = self.cached_query(*key, adaptive=adaptive)
+        except Exception as e:
+            result = e
+        with self.lock:
+            self.answers[key] = result
+            self.inflight.pop(key).set()
+        return result
+
+    def cached_query(self, ip, name, rdtype, adaptive=False):
+        if not self.root.cache:
+            return self.timed_query(ip, name, rdtype, adaptive)
+        key = (ip, name.lower(), rdtype)
+        result = self.root.cache.get(key)
+        if result is None:
+            try:
+                result = self.timed_query(ip, name, rdtype, adaptive)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.Timeout) as e:
+                result = e
+            self.root.cache.put(key, result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def timed_query(self, ip, name, rdtype, adaptive=False):
+        rtt = self.root.rtt
+        start = time.time()
+        timeout = rtt.timeout(ip)
+        if not adaptive:
+            timeout = max(timeout, getattr(self.root.transport, 'timeout', rtt.default))
+        if self.root.deadline:
+            # Don't wait for an answer beyond the deadline
+            timeout = max(min(timeout, self.root.deadline - start), 0.01)
+        try:
+            result = self.root.transport.query(ip, name, rdtype, timeout)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers) as e:
+            # SERVFAIL is an answer too, the server is reachable
+            result = e
+            rtt.success(ip, time.time() - start)
+        except dns.resolver.Timeout as e:
+            result = e
+            rtt.failure(ip)
+        else:
+            rtt.success(ip, time.time() - start)
+        if self.root.stats:
+            self.root.stats.sent[(ip, name, rdtype)] = time.time() - start
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def cancel(self):
+        # Make a trace that's running in another thread stop at its next query
+        self.root.cancelled = True
+
+    def out_of_time(self):
+        return bool(self.root.deadline) and time.time() > self.root.deadline
+
+    def inconsistencies(self, skip=[], names=None):
+        # Everything graph() would draw in red, as Inconsistency objects
+        if names:
+            names, zones = self.subtree(names)
+        else:
+            names, zones = self.names.keys(), self.subzones.values() + [self]
+        skip = set(skip)
+        ret = []
+
+        for name in sorted(names):
+            name_ = self.names[name]
+            via = name_.via
+            # Nameservers that weren't asked because the trace was cut off
+            # don't disagree with anybody
+            all_ns = unique([ns for address in name_.addresses if address != truncated for ns in name_.addresses[address]])
+            for address in name_.addresses:
+                if address == truncated:
+                    continue
+                if address in name_.errors:
+                    kind = address == dns_errors['UPWARD'] and Inconsistency.UPWARD_REFERRAL or Inconsistency.ERROR
+                    for ns in name_.addresses[address]:
+                        if ns.zone.name not in skip:
+                            ret.append(Inconsistency(kind, name, ns, address))
+                    continue
+                for ns in all_ns:
+                    if ns.zone.name not in skip and ns not in name_.answered_by[address]:
+                        ret.append(Inconsistency(Inconsistency.MISSING_ANSWER, name, ns, address))
+                for ns in name_.addresses[address]:
+                    if ns.zone.name in skip or (address, ns) not in via:
+                        continue
+                    missing = [x for x in ns.ip if x not in via[address, ns]]
+                    if missing:
+                        ret.append(Inconsistency(Inconsistency.MISSING_ANSWER, name, ns, address, missing))
+
+        for zone in sorted(zones, key=lambda x: x.name):
+            if zone.name in skip:
+                continue
+            all_upns = unique([upns for ns in zone.resolvers for upns in zone.resolvers[ns].up])
+            for ns in sorted(zone.resolvers):
+                resolver = zone.resolvers[ns]
+                for upns in all_upns:
+                    if upns.zone.name not in skip and upns not in resolver.up_index:
+                        ret.append(Inconsistency(Inconsistency.MISSING_DELEGATION, zone.name, resolver, upns.name))
+        return ret
+
+    def index(self):
+        # A summary of the tree that's small enough to read on every page
+        # view: what's in it and what's wrong with it
+        error_counts = collections.Counter()
+        for name in self.names.values():
+            for address in name.addresses:
+                if address in name.errors:
+                    error_counts[address] += len(name.addresses[address])
+        return {
+            'version': Journal.version,
+            'zones': sorted(self.subzones.keys() + ['.']),
+            'names': sorted(self.names.keys()),
+            'errors': dict(error_counts),
+            'inconsistencies': dict(collections.Counter([x.kind for x in self.inconsistencies()])),
+            'truncated': len([x for x in self.names.values() if truncated in x.addresses]),
+            'stats': self.stats and self.stats.summary() or None,
+        }
 
     def find_root_resolvers(self):
-        for root in 'abcdefghijklm':
-            root += '.root-servers.net.'
+        servers = {}
+        for root, ipv4, ipv6 in self.transport.root_hints:
+            servers[root] = [x for x in (ipv4, ipv6_available() and ipv6) if x]
+        if self.prime:
+            servers = self.prime_root_servers(servers) or servers
+        for root in servers:
             self.resolvers[root] = Resolver(self, root)
-            self.resolvers[root].ip = [x.address for x in dns.resolver.query(root,rdtype=dns.rdatatype.A).response.answer[0]]
-            self.resolvers[root].up = []
+            self.resolvers[root].ip = servers[root]
+            self.changed(self.resolvers[root])
+
+    def changed(self, obj):
+        # Remember changed resolvers and names, so they can be written to the
+        # journal if there is one
+        if self.root.journal:
+            self.root.journal.dirty.add(obj)
+
+    def prime_root_servers(self, hints):
+        # RFC 8109: ask a single root server for the NS records of the root,
+        # the glue gives us the addresses of all root servers.
+        with primed_root_lock:
+            primed_root = primed_roots.setdefault(self.transport, {'expires': 0, 'servers': None})
+            if primed_root['expires'] > time.time():
+                return primed_root['servers']
+            for hint in random.sample(hints.keys(), len(hints)):
+                log("Priming root servers using %s (%s)" % (hint, hints[hint][0]))
+                try:
+                    ans = self.transport.query(hints[hint][0], '.', dns.rdatatype.NS)
+                except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.Timeout):
+                    continue
+                servers = {}
+                ttl = None
+                for record in ans.response.answer:
+                    if record.rdtype == dns.rdatatype.NS and record.name.to_text() == '.':
+                        ttl = record.ttl
+                        for item in record.items:
+                            servers[item.target.to_text().lower()] = []
+                for record in ans.response.additional:
+                    name = record.name.to_text().lower()
+                    if record.rdtype in nameserver_rdtypes() and name in servers:
+                        servers[name] += [x.address for x in record.items]
+                servers = dict([(x, servers[x]) for x in servers if servers[x]])
+                if servers:
+                    primed_root['expires'] = time.time() + ttl
+                    primed_root['servers'] = servers
+                    return servers
+            log("Priming failed, using built-in root hints")
 
-    def graph(self, skip=[], errors_only=False):
+    def graph(self, skip=[], errors_only=False, names=None):
         graph = ["digraph dns {", "    rankdir=LR;", "    subgraph {", "        rank=same;"]
 
+        if names:
+            names, zones = self.subtree(names)
+        else:
+            names, zones = self.names.keys(), self.subzones.values() + [self]
+        names = sorted(names)
+        skip = set(skip)
+
         # Add all final resolution results
-        for name in sorted(self.names):
+        for name in names:
             for address in self.names[name].addresses:
                 address_ = address.replace("\\", "\\\\").replace('"', "\\\"")
-                if address in dns_errors.values():
+                if address in self.names[name].errors:
                     graph.append('        "%s" [shape="box",color="red",fontcolor="red"];' % address)
+                elif address == truncated:
+                    graph.append('        "%s" [shape="box",style="dashed",color="orange",fontcolor="orange"];' % address)
                 elif not errors_only:
                     graph.append('        "%s" [shape="doubleoctagon"];' % address_)
         graph.append("    }")
 
         # Final hops
-        for name in sorted(self.names):
-            all_ns = set()
-            for address in self.names[name].addresses:
-                all_ns.update(self.names[name].addresses[address])
-            for address in self.names[name].addresses:
+        for name in names:
+            name_ = self.names[name]
+            via = name_.via
+            errors = name_.errors
+            all_ns = unique([ns for address in name_.addresses if address != truncated for ns in name_.addresses[address]])
+            for address in name_.addresses:
                 address_ = address.replace("\\", "\\\\").replace('"', "\\\"")
-                for ns in self.names[name].addresses[address]:
+                for ns in name_.addresses[address]:
                     if ns.zone.name in skip:
                         continue
-                    if address in dns_errors.values():
-                        graph.append('    "%s" -> "%s" [label="%s",color="red",fontcolor="red"];' % (ns.name, address, name))
+                    # When not all addresses of a nameserver gave this
+                    # answer, say which ones did
+                    ips = via.get((address, ns), ns.ip)
+                    label = len(ips) < len(ns.ip) and '%s @%s' % (name, ', '.join(ips)) or name
+                    if address in errors:
+                        graph.append('    "%s" -> "%s" [label="%s",color="red",fontcolor="red"];' % (ns.name, address, label))
+                    elif address == truncated:
+                        graph.append('    "%s" -> "%s" [label="%s",style="dashed",color="orange",fontcolor="orange"];' % (ns.name, address, label))
                     elif not errors_only:
-                        graph.append('    "%s" -> "%s" [label="%s"];' % (ns.name, address_, name))
+                        graph.append('    "%s" -> "%s" [label="%s"];' % (ns.name, address_, label))
                 # Missing links
-                if address in dns_errors.values():
+                if address in errors or address == truncated:
                     continue
+                for ns in name_.addresses[address]:
+                    if ns.zone.name in skip or (address, ns) not in via:
+                        continue
+                    missing = [x for x in ns.ip if x not in via[address, ns]]
+                    if missing:
+                        graph.append('    "%s" -> "%s" [label="(%s @%s)",color="red",fontcolor="red"];' % (ns.name, address_, name, ', '.join(missing)))
                 for ns in all_ns:
                     if ns.zone.name in skip:
                         continue
-                    if ns in self.names[name].addresses[address]:
+                    if ns in name_.answered_by[address]:
                         continue
                     graph.append('    "%s" -> "%s" [label="(%s)",color="red",fontcolor="red"];' % (ns.name, address_, name))
 
         # And hop all zones back
-        for zone in sorted(self.subzones.values() + [self], key=lambda x: x.name):
+        for zone in sorted(zones, key=lambda x: x.name):
             if zone.name in skip:
                 continue
-            all_upns = set()
-            for ns in zone.resolvers:
-                all_upns.update(zone.resolvers[ns].up)
+            all_upns = unique([upns for ns in zone.resolvers for upns in zone.resolvers[ns].up])
             for ns in zone.resolvers:
+                resolver = zone.resolvers[ns]
                 if not errors_only:
-                    for upns in zone.resolvers[ns].up:
+                    for upns in resolver.up:
                         if upns.zone.name in skip:
                             continue
                         graph.append('    "%s" -> "%s" [label="%s"];' % (upns.name, ns, zone.name))
@@ -154,7 +596,7 @@ class Zone(object):
                 for upns in all_upns:
                     if upns.zone.name in skip:
                         continue
-                    if upns in zone.resolvers[ns].up:
+                    if upns in resolver.up_index:
                         continue
                     graph.append('    "%s" -> "%s" [label="%s",color="red",fontcolor="red"];' % (upns.name, ns, zone.name))
 
@@ -162,6 +604,13 @@ class Zone(object):
         return graph
 
     def dump(self, format, fd):
+        if format == 'jsonl':
+            journal = Journal(fd)
+            journal.add(self)
+            journal.flush()
+            if self.stats:
+                journal.write_stats(self.stats)
+            return
         if format == 'yaml':
             import yaml
             return yaml.dump(self.serialize(), fd)
@@ -170,7 +619,9 @@ class Zone(object):
             return json.dump(self.serialize(), fd)
 
     @classmethod
-    def load(klass, format, fd):
+    def load(klass, format, fd, names=None):
+        if format == 'jsonl':
+            return LazyDump(fd).tree(names)
         if format == 'yaml':
             import yaml
             return klass.deserialize(yaml.safe_load(fd))
@@ -191,8 +642,10 @@ class Zone(object):
             'zones': [],
             'names': [],
         }
+        if self.expires:
+            ret['expires'] = self.expires
         if self.name == '.':
-            done = ['.']
+            done = set(['.'])
             # Order them in such a way that we don't need to jump through hoops when deserializing
             def add_zone(zone):
                 if zone.name in done:
@@ -202,17 +655,20 @@ class Zone(object):
                         if up.zone.name not in done:
                             add_zone(up.zone)
                 ret['zones'].append(zone.serialize())
-                done.append(zone.name)
+                done.add(zone.name)
 
             for zone in self.subzones.values():
                 add_zone(zone)
             for name in self.names.values():
                 ret['names'].append(name.serialize())
+            if self.stats:
+                ret['stats'] = self.stats.summary()
         return ret
 
     @classmethod
     def deserialize(klass, data, root=None):
         inst = klass(data['name'], root)
+        inst.expires = data.get('expires')
         for resolver in data['resolvers']:
             resolver = Resolver.deserialize(resolver, inst)
             inst.resolvers[resolver.name] = resolver
@@ -225,112 +681,248 @@ class Zone(object):
             inst.subzones.pop('.')
             for name in data['names']:
                 name = Name.deserialize(name, inst)
-                inst.names[name.name] = name
+                inst.names[name.key] = name
         return inst
 
 class Name(object):
-    def __init__(self, name):
-        self.name = name
+    __slots__ = ('name', 'rdtype', 'addresses', 'answered_by', '_via', 'expires')
+
+    def __init__(self, name, rdtype=None):
+        self.name = interned(name)
+        # Only set when tracing several rdtypes at once, see name_key
+        self.rdtype = rdtype and interned(rdtype)
         self.addresses = {}
+        # Index on addresses, so graphing doesn't need to scan lists
+        self.answered_by = {}
+        # Which addresses of a nameserver gave an answer, only known when
+        # all addresses of all nameservers are queried
+        self._via = None
+        # When the answers expire, errors aren't cached
+        self.expires = None
+
+    @property
+    def via(self):
+        return self._via or {}
+
+    @property
+    def errors(self):
+        # Answers that are errors. A name traced for several rdtypes at once
+        # needn't have all of them, so NODATA is no error for those.
+        if self.rdtype:
+            return typed_errors
+        return all_errors
+
+    @property
+    def key(self):
+        return name_key(self.name, self.rdtype)
+
+    @classmethod
+    def for_key(klass, key):
+        name, _, rdtype = key.partition(' ')
+        return klass(name, rdtype or None)
+
+    def add(self, address, resolver, via=None):
+        address = interned(address)
+        if address in self.addresses:
+            if not (via and resolver in self.answered_by[address]):
+                self.addresses[address].append(resolver)
+                self.answered_by[address].add(resolver)
+        else:
+            self.addresses[address] = [resolver]
+            self.answered_by[address] = set([resolver])
+        if via:
+            if self._via is None:
+                self._via = {}
+            ips = self._via.setdefault((address, resolver), [])
+            if via not in ips:
+                ips.append(interned(via))
 
     def serialize(self):
-        return {
+        ret = {
             'name': str(self.name),
             'addresses': dict([(addr, [[res.zone.name, res.name] for res in self.addresses[addr]]) for addr in self.addresses])
         }
+        if self.rdtype:
+            ret['rdtype'] = self.rdtype
+        if self.via:
+            ret['via'] = sorted([[addr, res.zone.name, res.name, ips] for (addr, res), ips in self.via.items()])
+        if self.expires:
+            ret['expires'] = self.expires
+        return ret
 
     @classmethod
     def deserialize(klass, data, root):
-        inst = klass(data['name'])
+        inst = klass(data['name'], data.get('rdtype'))
         for addr in data['addresses']:
-            inst.addresses[addr] = []
             for zone,resolver in data['addresses'][addr]:
                 if zone == '.':
-                    inst.addresses[addr].append(root.resolvers[resolver])
+                    inst.add(addr, root.resolvers[resolver])
                 else:
-                    inst.addresses[addr].append(root.subzones[zone].resolvers[resolver])
+                    inst.add(addr, root.subzones[zone].resolvers[resolver])
+        for addr, zone, resolver, ips in data.get('via', []):
+            resolver = zone == '.' and root.resolvers[resolver] or root.subzones[zone].resolvers[resolver]
+            for ip in ips:
+                inst.add(addr, resolver, ip)
+        inst.expires = data.get('expires')
         return inst
 
 class Resolver(object):
+    __slots__ = ('zone', 'name', 'root', 'ip', 'up', 'up_index')
+
     def __init__(self, zone, name):
         self.zone = zone
-        self.name = name
+        self.name = interned(name)
         self.root = self.zone.root
         self.ip = []
         self.up = []
+        self.up_index = set()
+
+    def add_up(self, resolver):
+        if resolver not in self.up_index:
+            self.up.append(resolver)
+            self.up_index.add(resolver)
+            self.root.changed(self)
+
+    def register_error(self, name, msg, via=None):
+        # name is a key of root.names, see name_key
+        if name not in self.root.names:
+            self.root.names[name] = Name.for_key(name)
+        self.root.names[name].add(msg, self, via)
+        self.root.changed(self.root.names[name])
 
     def resolve(self, name, rdtype=dns.rdatatype.A, register=True):
+        if register:
+            if not name.endswith('.'):
+                name += '.'
+            try:
+                return Scheduler(self.root).run(Task(Task.NAMESERVER, self.zone, name, rdtype, self))
+            finally:
+                self.root.stop_prefetching()
+        # A simple lookup, that doesn't add anything to the tree
         if not self.ip:
             log("Did not receive glue record for %s" % self.name)
             if name == self.name:
                 return ["No glue"]
             if self.zone.trace_missing_glue and (self.name != 'm.gtld-servers.net.' or self.zone.even_trace_m_gtld_servers_net):
                 self.root.trace(self.name, dns.rdatatype.A)
-                if self.root.names[self.name].addresses:
-                    self.ip = self.root.names[self.name].addresses.keys()
+                current = self.root.scheduler and self.root.scheduler.current
+                key = current and current.name_key(self.name, dns.rdatatype.A) or self.name
+                if self.root.names[key].addresses:
+                    self.ip = self.root.names[key].addresses.keys()
             else:
                 self.ip = self.root.resolve(self.name, dns.rdatatype.A)
+            self.root.changed(self)
         if not self.ip or self.ip == ['NODATA']:
-            if register:
-                msg = 'NODATA'
-                if name not in self.root.names:
-                    self.root.names[name] = Name(name)
-                name = self.root.names[name]
-                if msg not in name.addresses:
-                    name.addresses[msg] = []
-                name.addresses[msg].append(self)
             return ["Resolver has no IP"]
-        res = dns.resolver.Resolver(configure=False)
-        res.timeout = 2.0
-        for ip in self.ip[:1]:
-            res.nameservers = self.ip[:1]
-            log("Trying to resolve %s (%s) on %s (%s) (R:%s)" % (name, dns.rdatatype.to_text(rdtype), self.name, self.ip[0], register))
+        # Try all addresses, fastest first, until one of them answers
+        for retry, ip in enumerate(self.root.rtt.order(self.ip)):
+            log("Trying to resolve %s (%s) on %s (%s) (R:False)" % (name, dns.rdatatype.to_text(rdtype), self.name, ip))
+            start = time.time()
             try:
-                ans = res.query(name, rdtype=rdtype, raise_on_no_answer=False)
-            except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.Timeout):
-                # Insert a bogus name node for NXDOMAIN/SERVFAIL
-                msg = dns_errors[sys.exc_type]
-                if not register:
-                    return
-                if name not in self.root.names:
-                    self.root.names[name] = Name(name)
-                name = self.root.names[name]
-                if msg not in name.addresses:
-                    name.addresses[msg] = []
-                name.addresses[msg].append(self)
+                ans = self.root.query(ip, name, rdtype, adaptive=True)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.Timeout) as e:
+                if self.root.stats:
+                    self.root.stats.add(self, ip, name, rdtype, start, e, retry)
+                if dns_errors[e.__class__] == 'NXDOMAIN':
+                    return []
+                continue
+            if self.root.stats:
+                self.root.stats.add(self, ip, name, rdtype, start, ans, retry)
+
+            if not ans.response.answer:
+                return self.process_auth(name, rdtype, ans, False)
+            return self.process_answer(name, rdtype, ans, False)
+
+    def trace_step(self, task):
+        # Ask this nameserver about a name as part of a trace. Without glue,
+        # its own name is traced or looked up first.
+        if not self.ip:
+            log("Did not receive glue record for %s" % self.name)
+            if task.name == self.name:
+                return
+            if self.zone.trace_missing_glue and (self.name != 'm.gtld-servers.net.' or self.zone.even_trace_m_gtld_servers_net):
+                self.root.scheduler.add([Task(Task.TRACE, self.root, self.name, dns.rdatatype.A)])
+                self.root.scheduler.then(Task(Task.GLUED, self.zone, task.name, task.rdtypes, self))
                 return
+            self.ip = self.root.resolve(self.name, dns.rdatatype.A)
+            self.root.changed(self)
+        self.glued_step(task)
+
+    def glued_step(self, task):
+        if task.kind == Task.GLUED:
+            # Our own name has been traced now
+            key = task.name_key(self.name, dns.rdatatype.A)
+            if key in self.root.names and self.root.names[key].addresses:
+                self.ip = self.root.names[key].addresses.keys()
+            self.root.changed(self)
+        if not self.ip or self.ip == ['NODATA']:
+            for key in task.name_keys():
+                self.register_error(key, 'NODATA')
+            return
+        # Traces look at the first address only, unless asked to look at all
+        # of them
+        ips = self.root.all_addresses and self.ip or self.ip[:1]
+        self.root.scheduler.add([Task(Task.QUERY, self.zone, task.name, task.rdtypes, self, ip) for ip in ips])
+
+    def query_step(self, task):
+        name, rdtype, ip = task.name, task.rdtype, task.ip
+        # Answers are recorded per address when looking at all of them
+        via = self.root.all_addresses and ip or None
+        log("Trying to resolve %s (%s) on %s (%s) (R:True)" % (name, dns.rdatatype.to_text(rdtype), self.name, ip))
+        start = time.time()
+        try:
+            ans = self.root.query(ip, name, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.Timeout) as e:
+            if self.root.stats:
+                self.root.stats.add(self, ip, name, rdtype, start, e)
+            if isinstance(e, dns.resolver.Timeout) and self.root.out_of_time():
+                # We stopped waiting for the answer, it may still have come
+                self.root.scheduler.truncate(task, "the deadline passed")
+                return
+            # Insert a bogus name node for NXDOMAIN/SERVFAIL
+            self.register_error(task.name_key(name, rdtype), dns_errors[e.__class__], via)
+        else:
+            if self.root.stats:
+                self.root.stats.add(self, ip, name, rdtype, start, ans)
 
             if not ans.response.answer:
-                return self.process_auth(name, rdtype, ans, register)
-            return self.process_answer(name, rdtype, ans, register)
+                if self.process_auth(name, rdtype, ans, True, via):
+                    # Delegated, the other rdtypes are asked about further down
+                    return
+            else:
+                self.process_answer(name, rdtype, ans, True, via)
+
+        if len(task.rdtypes) > 1:
+            # This nameserver doesn't delegate the name, so ask it about the
+            # other rdtypes as well
+            self.root.prefetch(self.root.scheduler.budget([(ip, name, x) for x in task.rdtypes[1:]]))
+            self.root.scheduler.add([Task(Task.QUERY, self.zone, name, x, self, ip) for x in task.rdtypes[1:]])
 
-    def process_auth(self, name, rdtype, ans, register):
+    def process_auth(self, name, rdtype, ans, register, via=None):
         # OK, we're being sent a level lower
+        task = register and self.root.scheduler.current
         zone = None
         for record in ans.response.authority:
             zonename = record.name.to_text()
-            if zonename in self.root.subzones and zonename != self.zone.name and self.zone.name.endswith(zonename):
+            if zonename != self.zone.name and (zonename == '.' or self.zone.name.endswith('.' + zonename)):
                 # They're trying to send us back up, nasty!
                 # Let's cut that off right now
                 if register:
-                    msg = 'NXDOMAIN'
-                    if name not in self.root.names:
-                        self.root.names[name] = Name(name)
-                    name = self.root.names[name]
-                    if msg not in name.addresses:
-                        name.addresses[msg] = []
-                    name.addresses[msg].append(self)
+                    self.register_error(task.name_key(name, rdtype), dns_errors['UPWARD'], via)
                 return
             if zonename == self.zone.name:
                 # Weird... no answer for our own zone?
-                if register:
-                    msg = 'NXDOMAIN'
-                    if name not in self.root.names:
-                        self.root.names[name] = Name(name)
-                    name = self.root.names[name]
-                    if msg not in name.addresses:
-                        name.addresses[msg] = []
-                    name.addresses[msg].append(self)
+                if not register:
+                    return
+                key = task.name_key(name, rdtype)
+                if task.typed:
+                    # The name exists, just not with this rdtype. That's an
+                    # answer when tracing several of them, and kept as long
+                    # as the zone says it may be.
+                    self.register_error(key, dns_errors['NODATA'], via)
+                    expire(self.root.names[key], record.rdtype == dns.rdatatype.SOA and min(record.ttl, record[0].minimum) or record.ttl)
+                else:
+                    self.register_error(key, 'NXDOMAIN', via)
                 return
             if record.rdtype == dns.rdatatype.NS:
                 if not register:
@@ -339,93 +931,88 @@ class Resolver(object):
                     if zonename not in self.root.subzones:
                         self.root.subzones[zonename] = Zone(zonename, self.root)
                     zone = self.root.subzones[zonename]
+                    expire(zone, record.ttl)
+                    self.root.changed(zone)
 
                 for item in record.items:
                     ns = item.target.to_text()
                     if ns not in zone.resolvers:
                         zone.resolvers[ns] = Resolver(zone, ns)
-                    if self not in zone.resolvers[ns].up:
-                        zone.resolvers[ns].up.append(self)
+                    zone.resolvers[ns].add_up(self)
 
         if not zone:
             # Seen with eg akamai's a0a.akamaiedge.net: resolvers return
             # NOERROR but only an SOA record when requesting A records (a0a
             # only has an ipv6 address)
             if register:
-                msg = 'NODATA'
-                if name not in self.root.names:
-                    self.root.names[name] = Name(name)
-                name = self.root.names[name]
-                if msg not in name.addresses:
-                    name.addresses[msg] = []
-                name.addresses[msg].append(self)
+                self.register_error(task.name_key(name, rdtype), 'NODATA', via)
             return
 
-        # Process glue records
+        # Process glue records, a nameserver can have both A and AAAA glue
+        glue = {}
+        rdtypes = nameserver_rdtypes()
         for record in ans.response.additional:
-            if record.rdtype in rdtypes_for_nameservers:
-                zone.resolvers[record.name.to_text().lower()].ip = [x.address for x in record.items]
+            if record.rdtype in rdtypes:
+                glue.setdefault(record.name.to_text().lower(), []).extend([interned(x.address) for x in record.items])
+        for ns in glue:
+            zone.resolvers[ns].ip = glue[ns]
+            self.root.changed(zone.resolvers[ns])
 
         # Simple resolution?
         if not register:
             return zone.resolve(name, rdtype)
 
-        # We're doing a depth-first search, so by now the name may actually be resolved already
-        if name not in self.root.names:
-            return zone.trace(name, rdtype)
+        # Unless the name has been resolved by the time we get there
+        self.root.scheduler.add([Task(Task.TRACE, zone, name, task.rdtypes, if_unknown=True)])
+        return True
 
-    def process_answer(self, name, rdtype, ans, register):
+    def process_answer(self, name, rdtype, ans, register, via=None):
         # Real answer
+        task = register and self.root.scheduler.current
         names = {}
         resolve = []
         orig_name = name.lower()
 
         for record in ans.response.answer:
             name = record.name.to_text().lower()
+            if register:
+                name = task.name_key(name, rdtype)
             if name not in names:
                 if name in self.root.names:
                     names[name] = self.root.names[name]
                 else:
-                    names[name] = Name(name)
+                    names[name] = Name.for_key(name)
             name = names[name]
+            if register:
+                expire(name, record.ttl)
 
             if record.rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
                 for x in record.items:
                     addr = x.address
-                    if addr not in name.addresses:
-                        name.addresses[addr] = []
-                    name.addresses[addr].append(self)
+                    name.add(addr, self, via)
 
             elif record.rdtype == dns.rdatatype.MX:
                 for x in record.items:
                     addr = x.exchange.to_text().lower()
-                    resolve.append((addr, 'A'))
-                    if addr not in name.addresses:
-                        name.addresses[addr] = []
-                    name.addresses[addr].append(self)
+                    resolve.append((addr, 'A', False))
+                    name.add(addr, self, via)
 
             elif record.rdtype == dns.rdatatype.CNAME:
                 for x in record.items:
                     cname = x.target.to_text().lower()
-                    resolve.append((cname, rdtype))
-                    if cname not in name.addresses:
-                        name.addresses[cname] = []
-                    name.addresses[cname].append(self)
+                    resolve.append((cname, register and task.rdtypes or rdtype, True))
+                    name.add(cname, self, via)
 
             elif record.rdtype == dns.rdatatype.SRV:
                 for x in record.items:
                     cname = x.target.to_text().lower()
-                    resolve.append((cname, 'A'))
-                    if cname not in name.addresses:
-                        name.addresses[cname] = []
-                    name.addresses[cname].append(self)
+                    resolve.append((cname, 'A', False))
+                    name.add(cname, self, via)
 
             elif record.rdtype in (dns.rdatatype.TXT, dns.rdatatype.SOA, dns.rdatatype.PTR):
                 for x in record.items:
                     addr = x.to_text()
-                    if addr not in name.addresses:
-                        name.addresses[addr] = []
-                    name.addresses[addr].append(self)
+                    name.add(addr, self, via)
 
             else:
                 raise RuntimeError("Unknown record:" + str(record))
@@ -434,9 +1021,12 @@ class Resolver(object):
             return names[orig_name].addresses.keys()
 
         self.root.names.update(names)
-        for name, newrdtype in resolve:
-            if name not in self.root.names:
-                self.root.trace(name, newrdtype)
+        for name in names.values():
+            self.root.changed(name)
+        # CNAMEs make chains, MX and SRV targets start a new one
+        chain = task.chain
+        self.root.scheduler.add([Task(Task.TRACE, self.root, name, newrdtype, if_unknown=True, chain=cname and chain + 1 or 0)
+                                 for name, newrdtype, cname in resolve])
 
     def serialize(self):
         return {
@@ -448,47 +1038,972 @@ class Resolver(object):
     @classmethod
     def deserialize(klass, data, zone):
         inst = klass(zone, data['name'])
-        inst.ip = data['ip']
+        inst.ip = [interned(x) for x in data['ip']]
         for zone, resolver in data['up']:
-            inst.up.append(inst.root.subzones[zone].resolvers[resolver])
+            inst.add_up(inst.root.subzones[zone].resolvers[resolver])
         return inst
 
-def root():
-    return Zone('.')
+class Task(object):
+    # One step of a trace, see Scheduler: tracing a name in a zone, asking a
+    # nameserver (finding its address first if it came without glue),
+    # continuing with that after its own name has been traced, or asking one
+    # of its addresses
+    TRACE = 'trace'
+    NAMESERVER = 'nameserver'
+    GLUED = 'glued'
+    QUERY = 'query'
+
+    __slots__ = ('kind', 'zone', 'name', 'rdtype', 'rdtypes', 'typed', 'resolver', 'ip', 'if_unknown', 'parent', 'depth',
+                 'chain', 'pending', 'then')
+
+    def __init__(self, kind, zone, name, rdtype, resolver=None, ip=None, if_unknown=False, chain=None, typed=None):
+        # With several rdtypes, delegations are followed asking for the first
+        # one and the nameservers that know the name are asked about all.
+        if not isinstance(rdtype, (list, tuple, set)):
+            rdtype = [rdtype]
+        self.rdtypes = tuple([isinstance(x, basestring) and dns.rdatatype.from_text(x) or x for x in rdtype])
+        # Whether names get a Name per rdtype, None for the same as the task
+        # that added this one
+        self.typed = typed
+        self.kind = kind
+        self.zone = zone
+        self.name = name
+        self.rdtype = self.rdtypes[0]
+        self.resolver = resolver
+        self.ip = ip
+        # Skip tracing the name if it is known by the time the task runs
+        self.if_unknown = if_unknown
+        self.parent = None
+        # How many traces deep this is: delegations, CNAME/MX/SRV targets
+        # and nameservers without glue
+        self.depth = 0
+        # How many CNAMEs led here, None for as many as led to the parent
+        self.chain = chain
+        # Tasks added by this one that haven't finished yet, and what to do
+        # when they have
+        self.pending = 0
+        self.then = None
+
+    def key(self):
+        return (self.kind, self.zone.name, self.resolver and self.resolver.name, self.name, self.rdtype, self.ip)
+
+    def name_key(self, name, rdtype):
+        # Where the answers for a name go in root.names
+        return name_key(name, self.typed and rdtype or None)
+
+    def name_keys(self):
+        return unique([self.name_key(self.name, x) for x in self.rdtypes])
+
+    def __repr__(self):
+        return '<Task %s %s %s %s%s%s>' % (self.kind, self.name, dns.rdatatype.to_text(self.rdtype), self.zone.name,
+                                           self.resolver and ' @' + self.resolver.name or '', self.ip and ' ' + self.ip or '')
+
+class DepthFirst(list):
+    def extend(self, tasks):
+        list.extend(self, reversed(tasks))
+
+class BreadthFirst(collections.deque):
+    def pop(self):
+        return self.popleft()
+
+class Prioritized(object):
+    # Lowest key first, and in the order they were added if equal
+    def __init__(self, key):
+        self.key = key
+        self.heap = []
+        self.count = itertools.count()
+
+    def extend(self, tasks):
+        for task in tasks:
+            heapq.heappush(self.heap, (self.key(task), next(self.count), task))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+def fastest_first(task):
+    # An order for Prioritized: ask the fastest nameservers first
+    return task.ip and task.zone.root.rtt.score(task.ip) or 0
+
+class Scheduler(object):
+    # Runs traces as tasks on a frontier, instead of recursing. Tracing a name
+    # in a zone asks all its nameservers, asking a nameserver asks its
+    # address (or all of them, with all_addresses), and answers lead to more
+    # tasks: tracing the name in the zone it was delegated to, tracing CNAME,
+    # MX and SRV targets and tracing nameservers that came without glue.
+    #
+    # The root's order says which task runs next: 'dfs' runs them in the
+    # order the recursive trace did, so the tree comes out the same, 'bfs'
+    # goes level by level and a function runs the task it gives the lowest
+    # key first. Orders other than 'dfs' can reach a task again before it
+    # has run, so they always skip nameservers and queries that already ran;
+    # 'dfs' only does that with the root's dedupe set. A name is never traced
+    # again while it's being traced, that'd never end.
+    #
+    # The root's max_queries, max_depth, max_cname_chain and deadline limit
+    # the number of queries, how many traces deep a trace goes, how long
+    # CNAME chains it follows and until when it runs. What goes over is cut
+    # off: the name gets the answer truncated from the nameservers that
+    # weren't asked, and the rest of the trace goes on.
+    def __init__(self, root):
+        self.root = root
+        if root.order == 'dfs':
+            self.frontier = DepthFirst()
+        elif root.order == 'bfs':
+            self.frontier = BreadthFirst()
+        else:
+            self.frontier = Prioritized(root.order)
+        self.dedupe = root.dedupe or root.order != 'dfs'
+        self.visited = set()
+        # The queries the trace made, for max_queries
+        self.queries = set()
+        self.truncated = 0
+        self.current = None
+
+    def run(self, task):
+        outer, self.root.scheduler = self.root.scheduler, self
+        if outer and outer.current:
+            # Traces started from within a trace, like lookups of nameservers
+            # without glue, count towards its limits
+            self.queries = outer.queries
+            task.depth = outer.current.depth + 1
+            task.chain = outer.current.chain
+            if task.typed is None:
+                task.typed = outer.current.typed
+        try:
+            self.push(None, [task])
+            while self.frontier:
+                task = self.frontier.pop()
+                if not self.skip(task):
+                    self.current = task
+                    try:
+                        if task.kind == Task.TRACE:
+                            task.zone.trace_step(task)
+                        elif task.kind == Task.NAMESERVER:
+                            task.resolver.trace_step(task)
+                        elif task.kind == Task.GLUED:
+                            task.resolver.glued_step(task)
+                        else:
+                            task.resolver.query_step(task)
+                    except Cancelled as e:
+                        # Only stop everything if asked to, running out of
+                        # time or queries cuts off what's left
+                        if self.root.cancelled:
+                            raise
+                        self.truncate(task, str(e))
+                    self.current = None
+                self.finish(task)
+        finally:
+            self.current = None
+            self.root.scheduler = outer
+            if outer and outer.current:
+                outer.truncated += self.truncated
+
+    def add(self, tasks):
+        # Tasks that follow from the running one
+        self.push(self.current, tasks)
+
+    def then(self, task):
+        # Run this when everything the running task added has finished
+        self.current.then = task
+
+    def push(self, parent, tasks):
+        for task in tasks:
+            task.parent = parent
+            if parent:
+                task.depth = parent.depth + (task.kind == Task.TRACE)
+                parent.pending += 1
+            if task.chain is None:
+                task.chain = parent and parent.chain or 0
+            if task.typed is None:
+                task.typed = parent and parent.typed or False
+        self.frontier.extend(tasks)
+
+    def finish(self, task):
+        while task and not task.pending:
+            parent = task.parent
+            if task.then:
+                then, task.then = task.then, None
+                self.push(parent, [then])
+            if parent:
+                parent.pending -= 1
+            task = parent
+
+    def skip(self, task):
+        root = self.root
+        if task.kind == Task.TRACE:
+            if task.if_unknown:
+                rdtypes = [x for x in task.rdtypes if task.name_key(task.name, x) not in root.names]
+                if not rdtypes:
+                    return True
+                task.rdtypes, task.rdtype = tuple(rdtypes), rdtypes[0]
+            parent = task.parent
+            while parent:
+                if parent.kind == Task.TRACE and (parent.zone, parent.name, parent.rdtypes) == (task.zone, task.name, task.rdtypes):
+                    log("Not tracing %s in %s again while tracing it" % (task.name, task.zone.name))
+                    return True
+                parent = parent.parent
+            if root.out_of_time():
+                return self.truncate(task, "the deadline passed")
+            if root.max_depth is not None and task.depth > root.max_depth:
+                return self.truncate(task, "that's more than %d traces deep" % root.max_depth)
+            if root.max_cname_chain is not None and task.chain > root.max_cname_chain:
+                return self.truncate(task, "that's more than %d CNAMEs deep" % root.max_cname_chain)
+            return False
+        if self.dedupe and task.kind in (Task.NAMESERVER, Task.QUERY):
+            key = task.key()
+            if key in self.visited:
+                return True
+            self.visited.add(key)
+        if root.out_of_time():
+            return self.truncate(task, "the deadline passed")
+        if task.kind == Task.QUERY and not self.budget([(task.ip, task.name, task.rdtype)]):
+            return self.truncate(task, "the trace made %d queries already" % len(self.queries))
+        return False
+
+    def budget(self, queries):
+        # Those of these (ip, name, rdtype) queries that the trace may make.
+        # Asking the same thing again doesn't count.
+        if self.root.max_queries is None:
+            return queries
+        ret = []
+        for key in queries:
+            if key not in self.queries:
+                if len(self.queries) >= self.root.max_queries:
+                    continue
+                self.queries.add(key)
+            ret.append(key)
+        return ret
+
+    def truncate(self, task, why):
+        if task.kind == Task.TRACE:
+            log("Not tracing %s in %s, %s" % (task.name, task.zone.name, why))
+            resolvers = sorted(task.zone.resolvers.values(), key=lambda x: x.name)
+        else:
+            log("Not asking %s about %s, %s" % (task.resolver.name, task.name, why))
+            resolvers = [task.resolver]
+        via = task.kind == Task.QUERY and self.root.all_addresses and task.ip or None
+        for resolver in resolvers:
+            for key in task.name_keys():
+                resolver.register_error(key, truncated, via)
+        self.truncated += 1
+        return True
+
+class Journal(object):
+    # Writes a tree as JSON Lines, one record per line. Zones and nameservers
+    # are numbered the first time they are written and referred to by number
+    # afterwards. Records only ever add to what was written before, so a
+    # journal can be written to while a trace is running: changed nameservers
+    # and names are collected in dirty and written by flush().
+    #
+    #   ["tracegraph", version]
+    #   ["z", zone_id, zone_name]
+    #   ["r", resolver_id, zone_id, resolver_name]
+    #   ["i", resolver_id, [ip, ...]]              (replaces earlier ones)
+    #   ["u", resolver_id, [resolver_id, ...]]     (nameservers delegating to it)
+    #   ["n", name, address, [resolver_id, ...]]   (nameservers giving this answer)
+    #   ["n", name]                                (name without answers)
+    #   ["d", zone_id, expires]                    (when the delegation expires)
+    #   ["x", name, expires]                       (when the answers expire)
+    #   ["v", name, address, resolver_id, [ip, ...]] (addresses of the
+    #                                                 nameserver giving this
+    #                                                 answer, if known)
+    #   ["s", {...}]                               (TraceStats.summary(), if
+    #                                              the trace was profiled)
+    #
+    # Names traced for several rdtypes at once are written as "name rdtype".
+    version = 1
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.dirty = set()
+        self.zones = {}
+        self.resolvers = {}
+        self.ips = {}
+        self.ups = {}
+        self.names = set()
+        self.answers = {}
+        self.via = {}
+        self.expires = {}
+        self.write(['tracegraph', self.version])
+
+    def write(self, record):
+        self.fd.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def add(self, root):
+        for zone in [root] + root.subzones.values():
+            self.dirty.add(zone)
+            self.dirty.update(zone.resolvers.values())
+        self.dirty.update(root.names.values())
+
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        resolvers = sorted([x for x in dirty if isinstance(x, Resolver)], key=lambda x: (x.zone.name, x.name))
+        names = sorted([x for x in dirty if isinstance(x, Name)], key=lambda x: x.key)
+        zones = sorted([x for x in dirty if isinstance(x, Zone)], key=lambda x: x.name)
+        for zone in zones:
+            if zone.expires and zone.expires != self.expires.get(zone):
+                self.write(['d', self.zone_id(zone), zone.expires])
+                self.expires[zone] = zone.expires
+        for resolver in resolvers:
+            self.write_resolver(resolver)
+        for name in names:
+            self.write_name(name)
+        self.fd.flush()
+
+    def write_stats(self, stats):
+        self.write(['s', stats.summary()])
+        self.fd.flush()
+
+    def zone_id(self, zone):
+        if zone.name not in self.zones:
+            self.zones[zone.name] = len(self.zones)
+            self.write(['z', self.zones[zone.name], zone.name])
+        return self.zones[zone.name]
+
+    def resolver_id(self, resolver):
+        key = (resolver.zone.name, resolver.name)
+        if key not in self.resolvers:
+            zone_id = self.zone_id(resolver.zone)
+            self.resolvers[key] = rid = len(self.resolvers)
+            self.ips[rid] = []
+            self.ups[rid] = 0
+            self.write(['r', rid, zone_id, resolver.name])
+        return self.resolvers[key]
+
+    def write_resolver(self, resolver):
+        rid = self.resolver_id(resolver)
+        if resolver.ip != self.ips[rid]:
+            self.ips[rid] = list(resolver.ip or [])
+            self.write(['i', rid, self.ips[rid]])
+        if len(resolver.up) > self.ups[rid]:
+            ups = [self.resolver_id(x) for x in resolver.up[self.ups[rid]:]]
+            self.ups[rid] = len(resolver.up)
+            self.write(['u', rid, ups])
+
+    def write_name(self, name):
+        key = name.key
+        if not name.addresses and key not in self.names:
+            self.write(['n', key])
+        self.names.add(key)
+        for address in name.addresses:
+            done = self.answers.get((key, address), 0)
+            resolvers = name.addresses[address]
+            if len(resolvers) > done:
+                self.write(['n', key, address, [self.resolver_id(x) for x in resolvers[done:]]])
+                self.answers[(key, address)] = len(resolvers)
+        for (address, resolver), ips in sorted(name.via.items(), key=lambda x: (x[0][0], x[0][1].zone.name, x[0][1].name)):
+            rid = self.resolver_id(resolver)
+            done = self.via.get((key, address, rid), 0)
+            if len(ips) > done:
+                self.write(['v', key, address, rid, ips[done:]])
+                self.via[(key, address, rid)] = len(ips)
+        if name.expires and name.expires != self.expires.get(name):
+            self.write(['x', key, name.expires])
+            self.expires[name] = name.expires
+
+class LazyDump(object):
+    # Reads a journal, but only parses the records that are needed for what
+    # is asked of it. Lines are grouped by the type of their record, which is
+    # always the third character, and names, zones and nameservers are picked
+    # by the start of their records before anything is parsed.
+    name_re = re.compile(r'^\["[nvx]",("(?:[^"\\]|\\.)*")')
+    id_re = re.compile(r'^\["[zdriu]",(\d+),')
+    resolver_re = re.compile(r'^\["r",(\d+),(\d+),')
+
+    def __init__(self, fd):
+        header = fd.readline()
+        if not header or json.loads(header) != ['tracegraph', Journal.version]:
+            raise ValueError("Not a tracegraph journal")
+        self.records = collections.defaultdict(list)
+        self.indexes = {}
+        for line in fd:
+            kind = line[2:3]
+            # Answers, nameservers giving them and expiry stay together, in
+            # the order they were written
+            if kind in ('v', 'x'):
+                kind = 'n'
+            self.records[kind].append(line)
+
+    def zones(self):
+        return [json.loads(x)[2] for x in self.records['z']]
+
+    def stats(self):
+        # The summary of the last profiled trace written to the journal
+        stats = self.records['s']
+        return stats and json.loads(stats[-1])[1] or None
+
+    def names(self):
+        names = set([self.raw_name(x) for x in self.records['n'] if x.startswith('["n"')])
+        return set([self.decode(x) for x in names])
+
+    def raw_name(self, line):
+        # The name of an n, v or x record as it was written, without parsing
+        # the record. Only names with escapes in them need a regex.
+        end = line.find('"', 6)
+        if '\\' in line[5:end]:
+            return self.name_re.match(line).group(1)
+        return line[5:end + 1]
+
+    def decode(self, name):
+        if '\\' in name:
+            return json.loads(name)
+        return unicode(name[1:-1])
+
+    def parse(self, kind, ids=None):
+        # All records of a kind, or only those for the given zone or
+        # nameserver ids
+        if ids is None:
+            return [json.loads(x) for x in self.records[kind]]
+        if kind not in self.indexes:
+            self.indexes[kind] = collections.defaultdict(list)
+            for line in self.records[kind]:
+                self.indexes[kind][int(self.id_re.match(line).group(1))].append(line)
+        return [json.loads(x) for id in ids for x in self.indexes[kind].get(id, [])]
+
+    def tree(self, names=None):
+        answers, decoded = collections.defaultdict(list), {}
+        for line in self.records['n']:
+            name = self.raw_name(line)
+            if name not in decoded:
+                decoded[name] = self.decode(name)
+            answers[decoded[name]].append(line)
+
+        # The names we need and the answers for them, including CNAME targets
+        todo = names is None and answers.keys() or [normalized_key(x) for x in names]
+        by_name = keys_by_name(answers)
+        wanted = {}
+        while todo:
+            name = todo.pop()
+            if name in wanted:
+                continue
+            if name not in answers:
+                # Traced for several rdtypes
+                todo += by_name.get(name, [])
+                continue
+            wanted[name] = [json.loads(x) for x in answers[name]]
+            todo += [x[2] for x in wanted[name] if x[0] != 'x' and len(x) > 2]
+
+        # And all zones involved in resolving those, following the
+        # nameservers that delegated to the ones that answered
+        ups = {}
+        if names is None:
+            needed = rids = None
+        else:
+            zone_of, by_zone = {}, collections.defaultdict(list)
+            for line in self.records['r']:
+                rid, zone_id = [int(x) for x in self.resolver_re.match(line).groups()]
+                zone_of[rid] = zone_id
+                by_zone[zone_id].append(rid)
+            needed, rids = set(), []
+            todo = [zone_of[rid] for records in wanted.values() for record in records if record[0] == 'n' and len(record) > 2 for rid in record[3]]
+            while todo:
+                zone_id = todo.pop()
+                if zone_id in needed:
+                    continue
+                needed.add(zone_id)
+                rids += by_zone[zone_id]
+                todo += [zone_of[x] for record in self.parse('u', by_zone[zone_id]) for x in record[2]]
+        for record in self.parse('u', rids):
+            ups.setdefault(record[1], []).extend(record[2])
+
+        zones = dict([(x[1], x[2]) for x in self.parse('z', needed)])
+        expires = dict([(x[1], x[2]) for x in self.parse('d', needed)])
+        resolvers = dict([(x[1], (x[2], x[3])) for x in self.parse('r', rids)])
+        ips = dict([(x[1], x[2]) for x in self.parse('i', rids)])
+
+        root = Zone('.')
+        objects = {}
+        for zone_id in zones:
+            if zones[zone_id] != '.':
+                root.subzones[zones[zone_id]] = Zone(zones[zone_id], root)
+                root.subzones[zones[zone_id]].expires = expires.get(zone_id)
+        for rid, (zone_id, name) in resolvers.items():
+            zone = zones[zone_id] == '.' and root or root.subzones[zones[zone_id]]
+            objects[rid] = zone.resolvers[name] = Resolver(zone, name)
+            objects[rid].ip = [interned(x) for x in ips.get(rid, [])]
+        for rid in objects:
+            for up in ups.get(rid, []):
+                objects[rid].add_up(objects[up])
+        for name, records in wanted.items():
+            inst = root.names[name] = Name.for_key(name)
+            for record in records:
+                if record[0] == 'x':
+                    inst.expires = record[2]
+                elif record[0] == 'v':
+                    for ip in record[4]:
+                        inst.add(record[2], objects[record[3]], ip)
+                elif len(record) > 2:
+                    for rid in record[3]:
+                        inst.add(record[2], objects[rid])
+        return root
+
+class Inconsistency(object):
+    # A nameserver that disagrees with the others. For missing answers,
+    # address is the answer the others gave, for missing delegations it is
+    # the parent nameserver that doesn't delegate to this one, for errors it
+    # is the error. ips are the addresses of the nameserver it applies to,
+    # if not all of them.
+    MISSING_DELEGATION = 'missing delegation'
+    MISSING_ANSWER = 'missing answer'
+    ERROR = 'error'
+    UPWARD_REFERRAL = 'upward referral'
+
+    def __init__(self, kind, name, resolver, address, ips=None):
+        self.kind = kind
+        self.name = name
+        self.zone = resolver.zone.name
+        self.server = resolver.name
+        self.address = address
+        self.ips = ips
+
+    def __str__(self):
+        server = self.ips and '%s (%s)' % (self.server, ', '.join(self.ips)) or self.server
+        if self.kind == self.MISSING_DELEGATION:
+            return "%s does not delegate %s to %s" % (self.address, self.name, server)
+        if self.kind == self.MISSING_ANSWER:
+            return "%s does not answer %s for %s" % (server, self.address, self.name)
+        if self.kind == self.UPWARD_REFERRAL:
+            return "%s refers %s upward" % (server, self.name)
+        return "%s answers %s for %s" % (server, self.address, self.name)
+
+    def __repr__(self):
+        return '<Inconsistency: %s>' % self
+
+def expire(obj, ttl):
+    # Zones and names expire when the first of the records they were built
+    # from expires. Records that expired before don't count anymore.
+    now = time.time()
+    if not obj.expires or obj.expires <= now or now + ttl < obj.expires:
+        obj.expires = now + ttl
+
+def name_key(name, rdtype=None):
+    # Names traced for several rdtypes at once get a Name per rdtype, kept
+    # in root.names as "name rdtype". Names don't contain spaces.
+    if rdtype is None:
+        return name
+    if not isinstance(rdtype, basestring):
+        rdtype = dns.rdatatype.to_text(rdtype)
+    return '%s %s' % (name, rdtype)
+
+def normalized_key(key):
+    name, _, rdtype = key.partition(' ')
+    return name_key(name.endswith('.') and name or name + '.', rdtype or None)
+
+def keys_by_name(keys):
+    # Which keys of root.names, or of something keyed like it, are for a name
+    ret = collections.defaultdict(list)
+    for key in keys:
+        if ' ' in key:
+            ret[key.partition(' ')[0]].append(key)
+    return ret
+
+def interned(value):
+    # The same zone, nameserver and answer names show up all over a tree, and
+    # in trees loaded from dumps they would all be separate strings
+    if type(value) is unicode:
+        try:
+            value = str(value)
+        except UnicodeEncodeError:
+            return value
+    return intern(value)
+
+def unique(items):
+    seen = set()
+    return [x for x in items if not (x in seen or seen.add(x))]
+
+class Prefetcher(object):
+    # Sends queries for a root in up to root.concurrency threads, which are
+    # started when there are queries waiting and reused until stop().
+    def __init__(self, root):
+        self.root = root
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def put(self, keys):
+        with self.lock:
+            for key in keys:
+                self.queue.put(key)
+            for x in range(min(self.root.concurrency, len(self.threads) + self.queue.qsize()) - len(self.threads)):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        # Queries that weren't sent yet are forgotten, queries that are being
+        # sent are waited for
+        with self.lock:
+            threads, self.threads = self.threads, []
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            for thread in threads:
+                self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            if not self.root.cancelled and not self.root.out_of_time():
+                self.root.fetch(key)
+
+class QueryCache(object):
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                expires, result = self.entries.pop(key)
+                if expires > time.time():
+                    self.entries[key] = (expires, result)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+
+    def put(self, key, result):
+        ttl = self.ttl(result)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, result)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    @staticmethod
+    def ttl(result):
+        # Answers live as long as their shortest-lived record, negative
+        # answers as long as the SOA says. Timeouts and SERVFAILs are never
+        # cached.
+        if isinstance(result, dns.resolver.NXDOMAIN):
+            responses = getattr(result, 'kwargs', {}).get('responses') or {}
+            responses = responses.values()
+        elif isinstance(result, Exception):
+            return 0
+        else:
+            responses = [result.response]
+        ttls = []
+        for response in responses:
+            for record in response.answer + response.authority + response.additional:
+                ttls.append(record.ttl)
+                if record.rdtype == dns.rdatatype.SOA:
+                    ttls.append(record.items[0].minimum)
+        return ttls and min(ttls) or 0
+
+query_cache = QueryCache()
+
+class RttTracker(object):
+    # Smoothed round-trip time and failures per nameserver address, used to
+    # pick timeouts for lookups that can try another nameserver and to try
+    # the fastest addresses first. Timeouts follow
+    # RFC 6298, servers that fail are avoided for a while, longer each time.
+    # Only the most recently used servers are remembered.
+    def __init__(self, timeout=2.0, min_timeout=0.2, max_timeout=5.0, max_backoff=300, size=10000):
+        self.default = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_backoff = max_backoff
+        self.size = size
+        self.servers = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def server(self, ip):
+        server = self.servers.pop(ip, None) or {'srtt': None, 'rttvar': None, 'timeout': self.default, 'failures': 0, 'until': 0}
+        self.servers[ip] = server
+        while len(self.servers) > self.size:
+            self.servers.popitem(last=False)
+        return server
+
+    def timeout(self, ip):
+        with self.lock:
+            if ip in self.servers:
+                return self.servers[ip]['timeout']
+            return self.default
+
+    def success(self, ip, rtt):
+        with self.lock:
+            server = self.server(ip)
+            if server['srtt'] is None:
+                server['srtt'], server['rttvar'] = rtt, rtt / 2
+            else:
+                server['rttvar'] = 0.75 * server['rttvar'] + 0.25 * abs(server['srtt'] - rtt)
+                server['srtt'] = 0.875 * server['srtt'] + 0.125 * rtt
+            server['timeout'] = min(max(server['srtt'] + 4 * server['rttvar'], self.min_timeout), self.max_timeout)
+            server['failures'] = 0
+            server['until'] = 0
+
+    def failure(self, ip):
+        with self.lock:
+            server = self.server(ip)
+            server['failures'] += 1
+            server['timeout'] = min(server['timeout'] * 2, self.max_timeout)
+            server['until'] = time.time() + min(2 ** server['failures'], self.max_backoff)
+
+    def score(self, ip):
+        # Servers that recently failed go last, the rest by expected RTT.
+        # Unknown servers are expected to be as slow as the default timeout.
+        with self.lock:
+            server = self.servers.get(ip)
+            if not server:
+                return (False, self.default)
+            srtt = server['srtt'] is None and self.default or server['srtt']
+            return (server['until'] > time.time(), srtt)
+
+    def order(self, ips):
+        return sorted(ips, key=self.score)
+
+    def clear(self):
+        with self.lock:
+            self.servers.clear()
+
+rtt_tracker = RttTracker()
+
+class TraceStats(object):
+    # Where the time of a trace goes: every query a resolver makes, and any
+    # other timed steps, like rendering the graph
+    def __init__(self):
+        self.queries = []
+        self.timings = collections.OrderedDict()
+        # Round-trip times of queries actually sent, by (ip, name, rdtype)
+        self.sent = {}
+        self.seen = set()
+
+    def add(self, resolver, ip, name, rdtype, start, result, retry=0):
+        end = time.time()
+        key = (ip, name, rdtype)
+        # Did this query go out on the network, or was it answered by the
+        # cache, or by an earlier identical query in this trace?
+        if key in self.seen:
+            source, rtt = 'trace', 0
+        elif key in self.sent:
+            source, rtt = 'network', self.sent[key]
+        else:
+            source, rtt = 'cache', 0
+        self.seen.add(key)
+
+        if isinstance(result, Exception):
+            outcome = dns_errors[type(result)]
+            responses = (getattr(result, 'kwargs', {}).get('responses') or {}).values()
+        else:
+            response = result.response
+            if response.answer:
+                outcome = 'ANSWER'
+            elif [x for x in response.authority if x.rdtype == dns.rdatatype.NS]:
+                outcome = 'REFERRAL'
+            else:
+                outcome = 'NODATA'
+            responses = [response]
+
+        self.queries.append({
+            'name': name,
+            'rdtype': dns.rdatatype.to_text(rdtype),
+            'zone': resolver.zone.name,
+            'server': resolver.name,
+            'ip': ip,
+            'outcome': outcome,
+            'source': source,
+            'start': start,
+            # Time spent on the network, and time the trace had to wait
+            # for the answer. With parallel queries the latter is often 0.
+            'rtt': rtt,
+            'wait': end - start,
+            'bytes': sum([len(x.to_wire()) for x in responses]),
+            'retry': retry,
+        })
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start
+
+    def slowest_servers(self, count=10):
+        servers = collections.defaultdict(list)
+        for query in self.queries:
+            if query['source'] == 'network':
+                servers[(query['server'], query['ip'])].append(query['rtt'])
+        servers = [{'server': server, 'ip': ip, 'queries': len(rtts), 'mean': sum(rtts) / len(rtts), 'max': max(rtts)}
+                   for (server, ip), rtts in servers.items()]
+        servers.sort(key=lambda x: (-x['mean'], x['server'], x['ip']))
+        return servers[:count]
+
+    def summary(self):
+        sources = collections.Counter([x['source'] for x in self.queries])
+        outcomes = collections.Counter([x['outcome'] for x in self.queries])
+        return {
+            'queries': len(self.queries),
+            'sent': sources['network'],
+            'cached': sources['cache'],
+            'reused': sources['trace'],
+            'retries': sum([x['retry'] for x in self.queries]),
+            'outcomes': dict(outcomes),
+            'bytes': sum([x['bytes'] for x in self.queries]),
+            # Total time spent waiting for nameservers, and the part of that
+            # the trace actually had to wait for
+            'total_latency': sum([x['rtt'] for x in self.queries]),
+            'critical_path': sum([x['wait'] for x in self.queries]),
+            'slowest_servers': self.slowest_servers(),
+            'timings': dict(self.timings),
+        }
+
+    def report(self):
+        summary = self.summary()
+        ret = [
+            "Queries: %d (%d sent, %d cached, %d answered earlier in the trace), %d retries" % (
+                summary['queries'], summary['sent'], summary['cached'], summary['reused'], summary['retries']),
+            "Outcomes: %s" % ', '.join(['%s %d' % x for x in sorted(summary['outcomes'].items())]),
+            "Latency: %.3fs total, %.3fs on the critical path" % (summary['total_latency'], summary['critical_path']),
+            "Received: %d bytes" % summary['bytes'],
+        ]
+        if self.timings:
+            ret.append("Timings: %s" % ', '.join(['%s %.3fs' % x for x in self.timings.items()]))
+        if summary['slowest_servers']:
+            ret.append("Slowest servers:")
+            for server in summary['slowest_servers']:
+                ret.append("  %.3fs mean, %.3fs max, %3d queries  %s (%s)" % (
+                    server['mean'], server['max'], server['queries'], server['server'], server['ip']))
+        return "\n".join(ret)
+
+class Transport(object):
+    # Sends queries to nameservers. Anything with a root_hints attribute and
+    # a query method that takes an optional timeout, and returns a
+    # dns.resolver.Answer or raises the same exceptions as
+    # dns.resolver.Resolver.query can be used instead, see fakedns.py for an
+    # example.
+    root_hints = root_hints
+
+    def __init__(self, timeout=2.0, tries=2):
+        self.timeout = timeout
+        self.tries = tries
+        self.semaphore = None
+
+    def limit(self, queries):
+        # Cap the number of queries in flight for all traces using this
+        # transport
+        self.semaphore = threading.BoundedSemaphore(queries)
+
+    def query(self, ip, name, rdtype, timeout=None):
+        res = dns.resolver.Resolver(configure=False)
+        res.timeout = timeout or self.timeout
+        res.lifetime = res.timeout * self.tries
+        res.nameservers = [ip]
+        if not self.semaphore:
+            return res.query(name, rdtype=rdtype, raise_on_no_answer=False)
+        with self.semaphore:
+            return res.query(name, rdtype=rdtype, raise_on_no_answer=False)
+
+default_transport = Transport()
+
+def root(concurrency=None, live=False, prime=False, transport=None, all_addresses=False, stats=False, tree=None,
+         max_queries=None, max_depth=None, max_cname_chain=None, deadline=None):
+    # Pass a loaded tree to continue tracing from there
+    inst = tree or Zone('.')
+    if concurrency:
+        inst.concurrency = concurrency
+    if transport:
+        # Don't mix these answers with the ones from the real internet
+        inst.transport = transport
+        inst.cache = QueryCache()
+        inst.rtt = RttTracker()
+    if live:
+        inst.cache = None
+    inst.prime = prime
+    inst.all_addresses = all_addresses
+    if stats:
+        inst.stats = TraceStats()
+    # Limits, see Scheduler. The deadline is in seconds from now.
+    inst.max_queries = max_queries
+    inst.max_depth = max_depth
+    inst.max_cname_chain = max_cname_chain
+    if deadline:
+        inst.deadline = time.time() + deadline
+    return inst
 
 if __name__ == '__main__':
     import optparse
 
-    usage = """%prog [options] name - Trace all resolution paths for a name and graph them
+    usage = """%prog [options] name [name...] - Trace all resolution paths for names and graph them
 
 Examples:
 %prog -t MX --graph png --output booking.png --skip . --skip com. booking.com
 %prog --skip . kaarsemaker.net --dump=kaarsemaker.yaml
-%prog --load broken_example.yaml --errors-only --graph png --output example.png"""
+%prog --load broken_example.yaml --errors-only --graph png --output example.png
+%prog --names-from customer.txt --dump=customer.yaml
+%prog --load customer.yaml --name www.customer.com --graph png --output www.png"""
 
     p = optparse.OptionParser(usage=usage)
     p.add_option('-q', '--quiet', dest='quiet', action="store_true", default=False,
                  help="No diagnostic messages")
-    p.add_option('-t', '--type', dest='rdtype', default='A', choices=('A', 'AAAA', 'MX', 'TXT', 'SRV', 'SOA', 'PTR'),
-                 help="Which record type to query")
+    p.add_option('-t', '--type', dest='rdtypes', action='append', default=[], choices=('A', 'AAAA', 'MX', 'TXT', 'SRV', 'SOA', 'PTR'),
+                 help="Which record type to query (may be repeated)")
     p.add_option('-d', '--dump', dest='dump', default=None, metavar='FILE',
                  help="Dump resolver data to a file")
     p.add_option('-l', '--load', dest='load', default=None, metavar='FILE',
                  help="Load resolver data from a file")
-    p.add_option('-f', '--format', dest='format', default='yaml', choices=('yaml','json'),
-                 help="Dump/load format")
+    p.add_option('-f', '--format', dest='format', default='yaml', choices=('yaml','json','jsonl'),
+                 help="Dump/load format (yaml, json or jsonl)")
     p.add_option('-g', '--graph', dest='graph', default=None, metavar='FORMAT',
                  choices=__dot_formats, help="Graph format, see dot(1)")
     p.add_option('-D', '--display', dest='display', action='store_true', default=False,
                  help='Display the result using GraphicsMagick\'s display(1)')
     p.add_option('-o', '--output', dest='output', default=None, metavar='FILE',
                  help="Filename for the graph")
+    p.add_option('-R', '--refresh', dest='refresh', action='store_true', default=False,
+                 help="Trace the names again, only querying what has expired in the loaded dump")
     p.add_option('-s', '--skip', dest='skip', action='append', default=[],
                  help="Zone to skip in the graph (may be repeated)")
+    p.add_option('-i', '--names-from', dest='names_from', default=None, metavar='FILE',
+                 help="Read names to trace from a file, one per line (- for stdin)")
+    p.add_option('-N', '--name', dest='names', action='append', default=[],
+                 help="Only graph the resolution of this name (may be repeated)")
     p.add_option('-e', '--errors-only', dest="errors_only", action="store_true", default=False,
                  help="Only show error nodes and vertices")
     p.add_option('-n', '--nagios', dest="nagios", action="store_true", default=False,
                  help="Function as a nagios plug-in")
+    p.add_option('--deadline', dest='deadline', type='float', default=None, metavar='SECONDS',
+                 help="Stop tracing after this many seconds and use what was found so far")
+    p.add_option('--max-queries', dest='max_queries', type='int', default=None, metavar='N',
+                 help="Stop tracing after this many queries and use what was found so far")
+    p.add_option('--max-depth', dest='max_depth', type='int', default=None, metavar='N',
+                 help="Don't follow more than this many delegations, CNAMEs and other targets in a row")
+    p.add_option('--max-cname-chain', dest='max_cname_chain', type='int', default=None, metavar='N',
+                 help="Don't follow more than this many CNAMEs in a row")
+    p.add_option('-c', '--concurrency', dest='concurrency', type='int', default=10, metavar='N',
+                 help="Number of nameservers to query in parallel (1 disables parallel queries)")
+    p.add_option('-L', '--live', dest='live', action='store_true', default=False,
+                 help="Do not use cached answers, query every nameserver for everything")
+    p.add_option('-P', '--prime', dest='prime', action='store_true', default=False,
+                 help="Ask a root server for the current root servers instead of using the built-in root hints")
+    p.add_option('-A', '--all-addresses', dest='all_addresses', action='store_true', default=False,
+                 help="Query every address of every nameserver, not just the first one")
+    p.add_option('-S', '--stats', dest='stats', action='store_true', default=False,
+                 help="Show query statistics and timings when done")
+    p.add_option('--profile', dest='profile', default=None, metavar='FILE',
+                 help="Write every query made, with timings, to FILE as JSON")
+    p.add_option('-4', '--ipv4', dest='ipv6', action='store_false', default=None,
+                 help="Only use IPv4 to talk to nameservers")
+    p.add_option('-6', '--ipv6', dest='ipv6', action='store_true',
+                 help="Also use IPv6 to talk to nameservers, even if it doesn't seem to be available")
+    p.add_option('-F', '--fake', dest='fake', default=None, metavar='FILE',
+                 help="Query a fake DNS hierarchy described in FILE instead of the internet, see fakedns.py")
     p.add_option('-T', '--trace-missing-glue', dest='trace_missing_glue', action='store_true', default=False,
                  help="Perform full traces for nameserver for which we did not receive glue records")
     p.add_option('--even-trace-m-gtld-servers-net', dest='even_trace_m_gtld_servers_net', action='store_true', default=False,
@@ -496,13 +2011,20 @@ Examples:
 
     opts, args = p.parse_args()
 
-    if opts.load:
+    if opts.names_from:
+        fd = opts.names_from == '-' and sys.stdin or open(opts.names_from)
+        args += [x.strip() for x in fd if x.strip() and not x.startswith('#')]
+
+    if opts.refresh and not opts.load:
+        p.error("--refresh needs a dump to --load")
+        p.exit(1)
+    if opts.load and not opts.refresh:
         if args:
             p.error("You're loading a dump so no extra queries")
             p.exit(1)
     else:
-        if len(args) != 1:
-            p.error("You must specify exactly one name to graph")
+        if not args:
+            p.error("You must specify at least one name to graph")
             p.exit(1)
 
     if not (opts.graph or opts.dump or opts.nagios):
@@ -511,45 +2033,104 @@ Examples:
 
     if opts.quiet or opts.nagios:
         log = lambda x: None
+    if opts.ipv6 is not None:
+        have_ipv6 = opts.ipv6
 
-    rdtype = dns.rdatatype.from_text(opts.rdtype)
+    # Several record types are traced together, and labeled in the graph
+    rdtypes = [dns.rdatatype.from_text(x) for x in unique(opts.rdtypes or ['A'])]
+    rdtype = len(rdtypes) == 1 and rdtypes[0] or rdtypes
     skip = [x if x.endswith('.') else x + '.' for x in opts.skip]
 
+    tree = None
     if opts.load:
         with open(opts.load) as fd:
-            root = Zone.load(opts.format, fd)
-    else:
-        name = args[0]
-        if rdtype == dns.rdatatype.PTR:
-            # If an IP address is given, convert it to .in-addr.arpa
-            try:
-                name = dns.reversename.from_address(name).to_text()
-            except dns.exception.SyntaxError:
-                pass
-        root = root()
+            tree = Zone.load(opts.format, fd, names=not opts.refresh and opts.names or None)
+    if not opts.load or opts.refresh:
+        names = []
+        for name in args:
+            if dns.rdatatype.PTR in rdtypes:
+                # If an IP address is given, convert it to .in-addr.arpa
+                try:
+                    name = dns.reversename.from_address(name).to_text()
+                except dns.exception.SyntaxError:
+                    pass
+            names.append(name)
+        transport = None
+        if opts.fake:
+            import fakedns
+            with open(opts.fake) as fd:
+                transport = fakedns.FakeTransport.load(fd)
+        root = root(concurrency=opts.concurrency, live=opts.live, prime=opts.prime, transport=transport,
+                    all_addresses=opts.all_addresses, stats=opts.stats or opts.profile, tree=tree,
+                    max_queries=opts.max_queries, max_depth=opts.max_depth, max_cname_chain=opts.max_cname_chain)
         root.trace_missing_glue = opts.trace_missing_glue
         root.even_trace_m_gtld_servers_net = opts.even_trace_m_gtld_servers_net
-        root.trace(name, rdtype=rdtype)
+        if opts.dump and opts.format == 'jsonl' and not tree:
+            # Write results as we go, so they're not lost if we're interrupted
+            root.journal = Journal(open(opts.dump, 'w'))
+        start = time.time()
+        if opts.deadline:
+            root.deadline = start + opts.deadline
+        with (root.stats or TraceStats()).timer('trace'):
+            if tree:
+                root.refresh(names, rdtype=rdtype)
+            else:
+                root.trace_names(names, rdtype=rdtype)
+        duration = time.time() - start
+        log("Saved %d queries by asking each nameserver only once" % root.saved)
+        if root.cache:
+            log("Cache: %d hits, %d misses" % (root.cache.hits, root.cache.misses))
+    else:
+        root = tree
+    incomplete = len([x for x in root.names.values() if truncated in x.addresses])
+    if incomplete:
+        log("The trace was cut off for %d names, results are incomplete" % incomplete)
 
-    if opts.dump:
+    if opts.dump and root.journal:
+        root.journal.flush()
+        if root.stats:
+            root.journal.write_stats(root.stats)
+        root.journal.fd.close()
+    elif opts.dump:
         with open(opts.dump, 'w') as fd:
             root.dump(opts.format, fd)
 
+    # Rendering is timed as well, also when graphing a loaded dump
+    if not root.stats and (opts.stats or opts.profile):
+        root.stats = TraceStats()
+    stats = root.stats or TraceStats()
     if opts.graph:
-        graph = root.graph(skip=skip, errors_only=opts.errors_only)
+        from whelk import shell, pipe
+        with stats.timer('graph'):
+            graph = root.graph(skip=skip, errors_only=opts.errors_only, names=opts.names)
         args = ["-T", opts.graph]
         if opts.output:
             args += ["-o", opts.output]
-        if opts.display:
-            pipe(pipe.dot(*args, input="\n".join(graph)) | pipe.display("-"))
-        else:
-            shell.dot(*args, input="\n".join(graph), stdout=sys.stdout)
+        with stats.timer('dot'):
+            if opts.display:
+                pipe(pipe.dot(*args, input="\n".join(graph)) | pipe.display("-"))
+            else:
+                shell.dot(*args, input="\n".join(graph), stdout=sys.stdout)
+
+    if opts.stats:
+        sys.stderr.write(root.stats.report() + "\n")
+    if opts.profile:
+        with open(opts.profile, 'w') as fd:
+            json.dump({'summary': root.stats.summary(), 'queries': root.stats.queries}, fd, indent=2)
 
     if opts.nagios:
-        graph = root.graph(errors_only=True)
-        nerrors = len([x for x in graph if '->' in x])
-        if nerrors:
-            print("%d inconsistenies in the dns graph, run with -e -g png for details" % nerrors)
+        inconsistencies = root.inconsistencies(names=opts.names)
+        perfdata = "inconsistencies=%d" % len(inconsistencies)
+        if not opts.load or opts.refresh:
+            perfdata += " queries=%d duration=%.3fs" % (len(root.answers), duration)
+        if inconsistencies:
+            print("%d inconsistenies in the dns graph%s, run with -e -g png for details | %s" % (
+                len(inconsistencies), incomplete and " (incomplete trace)" or "", perfdata))
+            for inconsistency in inconsistencies:
+                print(str(inconsistency))
             sys.exit(2)
+        elif incomplete:
+            print("DNS trace was cut off for %d names | %s" % (incomplete, perfdata))
+            sys.exit(3)
         else:
-            print("DNS trace graph consistent")
+            print("DNS trace graph consistent | %s" % perfdata)
@@ -5,14 +5,18 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.forms import ModelForm, TextInput, ValidationError
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.template import RequestContext
-from dnsgraph.models import DnsName, recordtypes
+from django.views.decorators.http import condition
+from dnsgraph.models import DnsName, queue_stats, recordtypes
 from django.conf import settings
 import re
-import yaml
 import tracegraph
-from whelk import shell
 import datetime
+import fcntl
+import hashlib
+import json
+import mimetypes
 import os
+import threading
 
 class DnsNameForm(ModelForm):
     # Not quite true, but good enough
@@ -53,37 +57,110 @@ def index(request):
 
     return render_to_response("dnsgraph/index.html", context_instance=RequestContext(request, {
         'form': form,
-        'jobs': DnsName.trace.stats()['current-jobs-ready'],
+        'queue': queue_stats(),
     }))
 
 def by_name(request, name, qtype):
     query = get_object_or_404(DnsName, name=name, qtype=qtype)
     query.maybe_trace()
-    zones = set('.')
+    zones = ['.']
 
     if query.available:
-        with open(query.data_path) as fd:
-            data = yaml.safe_load(fd)
-            zones = zones.union(set([x['name'] for x in data['zones']]))
+        index = query.index()
+        if index:
+            zones = index['zones']
 
     return render_to_response('dnsgraph/by_name.html', context_instance=RequestContext(request, {
         'query': query,
-        'zones': sorted(list(zones)),
-        'jobs': DnsName.trace.stats()['current-jobs-ready'],
+        'zones': zones,
+        'queue': queue_stats(),
     }))
 
-def as_png(request, name, qtype):
+def as_json(request, name, qtype):
+    # For scripts: what's in a trace and what's wrong with it
+    query = get_object_or_404(DnsName, name=name, qtype=qtype)
+    index = query.available and query.index()
+    if not index:
+        raise Http404
+    index['queried_at'] = query.queried_at.isoformat()
+    return HttpResponse(json.dumps(index), content_type='application/json')
+
+render_cache_size = getattr(settings, 'DNSGRAPH_RENDER_CACHE_SIZE', 500)
+
+def render_options(request):
     format = request.GET.get('format', 'png')
     if format not in tracegraph.__dot_formats and format != 'raw':
         format = 'png'
+    skip = sorted([x[5:] for x in request.GET if x.startswith('skip_')])
+    errors_only = bool(request.GET.get('errors_only'))
+    return format, skip, errors_only
+
+def render_key(request, name, qtype):
+    # Identifies a rendered graph: the trace data it was made from, the
+    # record type in it that is graphed and the options used to render it
+    query = get_object_or_404(DnsName, name=name, qtype=qtype)
+    try:
+        stat = os.stat(query.data_path)
+    except OSError:
+        return None
+    return hashlib.sha1(repr((query.data_path, query.qtype, stat.st_mtime, stat.st_size) + render_options(request))).hexdigest()
+
+def render_modified(request, name, qtype):
+    query = get_object_or_404(DnsName, name=name, qtype=qtype)
+    try:
+        return datetime.datetime.utcfromtimestamp(os.stat(query.data_path).st_mtime)
+    except OSError:
+        return None
+
+def render(query, key, format, skip, errors_only):
+    # Rendering big graphs with dot is slow, so rendered graphs are kept on
+    # disk. A lock per graph makes sure that concurrent requests for the same
+    # graph wait for one dot run instead of all running dot. Lock files stay
+    # until their graph is thrown away, and graphs are renamed into place so
+    # nobody ever reads half a graph.
+    cache_dir = os.path.join(settings.STATIC_ROOT, 'dnsgraph', 'rendered')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, key)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            os.utime(path, None)
+            with open(path) as fd:
+                return fd.read()
+        # The trace has all record types of the name, only graph ours
+        with open(query.data_path) as fd:
+            root = tracegraph.Zone.load('jsonl', fd, names=[query.key])
+        data = "\n".join(root.graph(skip=skip, errors_only=errors_only))
+        if format != 'raw':
+            from whelk import shell
+            data = shell.dot('-T', format, input=data).stdout
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'w') as fd:
+            fd.write(data)
+        os.rename(tmp, path)
+
+    # A graph was added, throw away the least recently used ones
+    files = [os.path.join(cache_dir, x) for x in os.listdir(cache_dir) if '.' not in x]
+    if len(files) > render_cache_size:
+        files.sort(key=lambda x: os.path.getmtime(x) if os.path.exists(x) else 0)
+        for file in files[:len(files) - render_cache_size]:
+            for file_ in (file, file + '.lock'):
+                try:
+                    os.unlink(file_)
+                except OSError:
+                    pass
+    return data
+
+@condition(etag_func=render_key, last_modified_func=render_modified)
+def as_png(request, name, qtype):
+    format, skip, errors_only = render_options(request)
     query = get_object_or_404(DnsName, name=name, qtype=qtype)
-    if not os.path.exists(query.data_path):
+    if not os.path.exists(query.data_path) or query.key not in query.index()['names']:
+        # Not traced yet, or not this record type
         query.trace()
         return HttpResponseRedirect('./%s/' % qtype)
-    with open(query.data_path) as fd:
-        root = tracegraph.Zone.load('yaml', fd)
-    skip = [x[5:] for x in request.GET if x.startswith('skip_')]
-    graph = root.graph(skip=skip)
+    data = render(query, render_key(request, name, qtype), format, skip, errors_only)
     if format == 'raw':
-        return HttpResponse("\n".join(graph), content_type='text/plain')
-    return HttpResponse(shell.dot('-T', format, input="\n".join(graph)).stdout, content_type='image/png')
+        return HttpResponse(data, content_type='text/plain')
+    return HttpResponse(data, content_type=mimetypes.guess_type('graph.' + format)[0] or 'application/octet-stream')